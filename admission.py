@@ -0,0 +1,220 @@
+from base64 import b64decode
+from math import ceil
+from os import environ as env, cpu_count
+from threading import Lock
+from time import monotonic
+from auth_cache import credential_cache
+from utils import json_bytes
+
+# paths never limited: the docs and the metrics endpoint
+EXEMPT = ('/docs', '/redoc', '/openapi.json', '/metrics')
+
+
+class RateLimiter:
+    '''Token buckets of `burst` tokens refilled at `rate` per second, one per key (a user, an IP address).
+
+        Keys idle long enough for their bucket to have refilled are forgotten once there are more than `max_keys`.
+    '''
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+
+        self._buckets = {}  # key -> [tokens, updated]
+        self._lock = Lock()
+
+    def _refilled(self, key, now: float):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                full = self.burst / self.rate
+                self._buckets = {k: b for k, b in self._buckets.items() if now - b[1] < full}
+            bucket = self._buckets[key] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        return bucket
+
+    def take(self, key):
+        '''Taking a token from a key's bucket, returning 0 if there was one, the seconds until there is one otherwise'''
+        with self._lock:
+            bucket = self._refilled(key, monotonic())
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / self.rate
+
+    def wait(self, key):
+        '''The seconds until a key's bucket has a token, without taking one'''
+        with self._lock:
+            bucket = self._refilled(key, monotonic())
+            return 0.0 if bucket[0] >= 1 else (1 - bucket[0]) / self.rate
+
+    def spend(self, key):
+        '''Taking a token even if there is none, so the bucket goes into debt (e.g. for a failure already served)'''
+        with self._lock:
+            bucket = self._refilled(key, monotonic())
+            bucket[0] = max(bucket[0] - 1, -self.burst)
+
+
+def route_class(method: str, path: str):
+    '''The class a request is limited by: 'auth', 'search', 'write' or 'read', None for exempt paths'''
+    if path.startswith(EXEMPT):
+        return None
+    if path in ('/register', '/activate'):
+        return 'auth'
+    if path in ('/messages/search', '/messages/export', '/testing'):
+        return 'search'
+    if method in ('POST', 'PUT', 'PATCH', 'DELETE'):
+        return 'write'
+    return 'read'
+
+
+def _basic_credentials(headers: list):
+    '''(email, password) of an HTTP Basic Authorization header, None if there is none or it's malformed'''
+    for name, value in headers:
+        if name == b'authorization':
+            scheme, _, encoded = value.partition(b' ')
+            if scheme.lower() != b'basic':
+                return None
+            try:
+                email, separator, password = b64decode(encoded, validate=True).decode('utf8').partition(':')
+            except ValueError:
+                return None
+            return (email, password) if separator else None
+    return None
+
+
+class AdmissionControl:
+    '''Deciding up front whether a request is served, so an overload is answered fast instead of queueing.
+
+        - `limits`: a RateLimiter per route class, keyed by the user (when their credentials are already verified
+          and cached) or the client IP address; 'auth' routes are always keyed by IP;
+        - `failures`: a RateLimiter per IP spent on every 401, an IP out of tokens gets no more credentials checked;
+        - `max_db`: requests in flight at once, each holding or waiting for a DB connection;
+        - `max_hashing`: requests in flight that will run bcrypt (uncached credentials, registration).
+
+        A rate limited request gets a 429, one over a concurrency cap a 503, both with Retry-After.
+        Limits are per process, each server worker admits its own share.
+    '''
+
+    def __init__(self, limits: dict, failures: RateLimiter = None, max_db: int = 0, max_hashing: int = 0):
+        self.limits = limits
+        self.failures = failures
+        self.max_db = max_db
+        self.max_hashing = max_hashing
+
+        self.in_flight = {'db': 0, 'hashing': 0}
+        self.stats = {'admitted': 0, 'rate_limited': 0, 'auth_failures_limited': 0, 'db_busy': 0, 'hashing_busy': 0}
+
+    @classmethod
+    def from_env(cls):
+        '''Limits from RATE_LIMIT_<CLASS> / AUTH_FAILURE_LIMIT as "rate per second,burst" (empty or 0 for none)
+            and the ADMISSION_MAX_DB / ADMISSION_MAX_HASHING caps (0 for none)
+        '''
+        def limiter(name: str, default: str):
+            rate, _, burst = env.get(name, default).partition(',')
+            if not rate or not float(rate):
+                return None
+            return RateLimiter(float(rate), float(burst or rate))
+
+        limits = {route: limiter(f'RATE_LIMIT_{route.upper()}', default)
+                  for route, default in (('auth', '1,10'), ('search', '5,20'), ('write', '5,20'), ('read', '50,100'))}
+
+        return cls({route: limit for route, limit in limits.items() if limit is not None},
+                   failures=limiter('AUTH_FAILURE_LIMIT', '0.2,10'),
+                   # twice the pool: one batch of requests holding connections and one waiting for them
+                   max_db=int(env.get('ADMISSION_MAX_DB', int(env.get('DB_POOL_MAX', 10)) * 2)),
+                   max_hashing=int(env.get('ADMISSION_MAX_HASHING', (cpu_count() or 1) * 2)))
+
+    def admit(self, method: str, path: str, ip: str, credentials: tuple):
+        '''Returning None to serve a request, (status code, detail, retry after) to turn it away;
+            an admitted request holds its in-flight slots until `release` is called with what `admit` returned
+        '''
+        route = route_class(method, path)
+        if route is None:
+            return None
+
+        user_id = credential_cache.get(*credentials) if credentials and route != 'auth' else None
+        hashing = path == '/register' if route == 'auth' else credentials is not None and user_id is None
+
+        limit = self.limits.get(route)
+        if limit is not None:
+            wait = limit.take(('user', user_id) if user_id is not None else ('ip', ip))
+            if wait:
+                self.stats['rate_limited'] += 1
+                return 429, 'Too many requests, please slow down.', wait
+
+        if hashing and credentials is not None and self.failures is not None:
+            wait = self.failures.wait(ip)
+            if wait:
+                self.stats['auth_failures_limited'] += 1
+                return 429, 'Too many failed sign-ins, please try again later.', wait
+
+        if self.max_db and self.in_flight['db'] >= self.max_db:
+            self.stats['db_busy'] += 1
+            return 503, 'The service is busy right now, please try again shortly.', 1
+
+        if hashing and self.max_hashing and self.in_flight['hashing'] >= self.max_hashing:
+            self.stats['hashing_busy'] += 1
+            return 503, 'The service is busy right now, please try again shortly.', 1
+
+        self.in_flight['db'] += 1
+        if hashing:
+            self.in_flight['hashing'] += 1
+        self.stats['admitted'] += 1
+        return route, hashing
+
+    def release(self, admitted: tuple):
+        self.in_flight['db'] -= 1
+        if admitted[1]:
+            self.in_flight['hashing'] -= 1
+
+    def failed(self, ip: str):
+        '''Recording a 401 served to an IP'''
+        if self.failures is not None:
+            self.failures.spend(ip)
+
+    def metrics(self):
+        return {**self.stats, 'in_flight': dict(self.in_flight)}
+
+
+class AdmissionMiddleware:
+    '''ASGI middleware turning away requests an AdmissionControl doesn't admit, before any DB or bcrypt work'''
+
+    def __init__(self, app, control: AdmissionControl):
+        self.app = app
+        self.control = control
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        ip = scope['client'][0] if scope.get('client') else None
+        decision = self.control.admit(scope['method'], scope['path'], ip, _basic_credentials(scope['headers']))
+
+        if decision is None:
+            return await self.app(scope, receive, send)
+
+        if isinstance(decision[0], int):
+            status_code, detail, retry_after = decision
+            body = json_bytes({'detail': detail})
+            await send({'type': 'http.response.start', 'status': status_code,
+                        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()),
+                                    (b'retry-after', str(max(ceil(retry_after), 1)).encode())]})
+            await send({'type': 'http.response.body', 'body': body})
+            return
+
+        async def send_watching(message):
+            if message['type'] == 'http.response.start' and message['status'] == 401:
+                self.control.failed(ip)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_watching)
+        finally:
+            self.control.release(decision)
+
+
+admission_control = AdmissionControl.from_env()
@@ -0,0 +1,90 @@
+from collections import OrderedDict
+from hashlib import blake2b
+from os import environ as env, urandom
+from threading import Lock
+from time import monotonic
+
+
+class CredentialCache:
+    '''A bounded LRU cache of recently verified HTTP Basic credentials, so repeat requests skip bcrypt and the DB.
+
+        Entries are keyed by a BLAKE2b digest of (email, password) keyed with a per-process secret,
+        so neither the plaintext nor anything usable offline is kept in memory.
+        Whatever changes a user's password or active flag has to call invalidate(user_id).
+    '''
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self._secret = urandom(32)
+        self._entries = OrderedDict()  # digest -> (user_id, expires_at), least recently used first
+        self._by_user = {}  # user_id -> {digest, ...}
+        self._lock = Lock()
+
+    def _digest(self, email: str, password: str):
+        h = blake2b(key=self._secret, digest_size=32)
+        # length-prefixing the email so ('ab', 'c') and ('a', 'bc') never collide
+        h.update(f'{len(email)}:{email}{password}'.encode('utf8'))
+        return h.digest()
+
+    def _forget(self, digest):
+        user_id, _ = self._entries.pop(digest)
+        digests = self._by_user.get(user_id)
+        if digests:
+            digests.discard(digest)
+            if not digests:
+                del self._by_user[user_id]
+
+    def get(self, email: str, password: str):
+        '''Getting the user id for credentials verified within the last `ttl` seconds, None otherwise'''
+        if not self.maxsize:
+            return None
+
+        digest = self._digest(email, password)
+
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+
+            if entry[1] <= monotonic():
+                self._forget(digest)
+                return None
+
+            self._entries.move_to_end(digest)
+            return entry[0]
+
+    def add(self, email: str, password: str, user_id: int):
+        if not self.maxsize:
+            return
+
+        digest = self._digest(email, password)
+
+        with self._lock:
+            if digest in self._entries:
+                self._forget(digest)
+
+            self._entries[digest] = (user_id, monotonic() + self.ttl)
+            self._by_user.setdefault(user_id, set()).add(digest)
+
+            while len(self._entries) > self.maxsize:
+                self._forget(next(iter(self._entries)))
+
+    def invalidate(self, user_id: int):
+        '''Dropping every cached credential of a user'''
+        with self._lock:
+            for digest in list(self._by_user.get(user_id, ())):
+                self._forget(digest)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+
+    def metrics(self):
+        return {'entries': len(self._entries)}
+
+
+credential_cache = CredentialCache(maxsize=int(env.get('AUTH_CACHE_SIZE', 1024)),
+                                   ttl=float(env.get('AUTH_CACHE_TTL', 300)))
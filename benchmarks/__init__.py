@@ -0,0 +1 @@
+'''Load tests and micro-benchmarks for the API, run with `python -m benchmarks --help` from the repo root'''
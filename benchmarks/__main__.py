@@ -0,0 +1,97 @@
+from argparse import ArgumentParser
+from os import environ as env
+import sys
+from dotenv import load_dotenv
+from benchmarks import report
+
+
+def main():
+    # before the defaults below are read from the environment
+    load_dotenv()
+
+    parser = ArgumentParser(prog='python -m benchmarks', description='Guestbook API benchmarks')
+    parser.add_argument('--url', default=env.get('BENCH_CONNECTION_URL'),
+                        help='the benchmark DB (BENCH_CONNECTION_URL), never the one with real data')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    seed = commands.add_parser('seed', help='apply ddl.sql and the migrations and seed the DB')
+    seed.add_argument('--reset', action='store_true', help='drop everything in the public schema first')
+    seed.add_argument('--users', type=int, default=100)
+    seed.add_argument('--messages', type=int, default=1000)
+    seed.add_argument('--upvotes', type=int, default=5000)
+    seed.add_argument('--pending', type=int, default=1000, help='inactive users with tokens, for the activate scenario')
+    seed.add_argument('--seed', type=int, default=42)
+
+    load = commands.add_parser('load', help='drive the endpoints of a running API')
+    load.add_argument('--base-url', default='http://127.0.0.1:8000')
+    load.add_argument('--scenarios', default='most_upvoted,list,search,post,upvote,register,activate',
+                      help='a comma separated subset of: most_upvoted, list, search, post, upvote, register, activate')
+    load.add_argument('--requests', type=int, default=1000)
+    load.add_argument('--concurrency', type=int, default=10)
+    load.add_argument('--warmup', type=int, default=50)
+    load.add_argument('--seed', type=int, default=42)
+    load.add_argument('--out', help='a JSON file for the results, stdout by default')
+
+    micro = commands.add_parser('micro', help='query composition, JSON rendering and bcrypt on their own')
+    micro.add_argument('--number', type=int, default=10000, help='calls per repetition of the composition benchmarks')
+    micro.add_argument('--bcrypt-number', type=int, default=20)
+    micro.add_argument('--out', help='a JSON file for the results, stdout by default')
+
+    startup = commands.add_parser('startup', help="time importing the app in a fresh interpreter, against a budget")
+    startup.add_argument('--module', default='main')
+    startup.add_argument('--repeat', type=int, default=5)
+    startup.add_argument('--budget-ms', type=float, default=float(env.get('IMPORT_BUDGET_MS', 0)),
+                         help='exit with status 1 if the median import takes longer (IMPORT_BUDGET_MS), 0 for no budget')
+    startup.add_argument('--out', help='a JSON file for the results, stdout by default')
+
+    compare = commands.add_parser('compare', help='compare two result files')
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        report.compare(args.baseline, args.current)
+        return
+
+    if args.command == 'startup':
+        from benchmarks.startup import import_time
+        results = import_time(args.module, args.repeat)
+        report.write_results('startup', {'module': args.module, 'repeat': args.repeat, 'budget_ms': args.budget_ms},
+                             results, args.out)
+
+        took = results[f'import_{args.module}']['median_ms']
+        if args.budget_ms and took > args.budget_ms:
+            sys.exit(f'importing {args.module} took {took:.0f} ms, over the {args.budget_ms:.0f} ms budget')
+        return
+
+    if not args.url:
+        parser.error('--url or BENCH_CONNECTION_URL is required')
+
+    # imported here, so comparing results works without the app's dependencies
+    if args.command == 'seed':
+        from benchmarks.seed import create_schema, seed as seed_db
+        create_schema(args.url, reset=args.reset)
+        print(seed_db(args.url, users=args.users, messages=args.messages, upvotes=args.upvotes,
+                      pending=args.pending, random_seed=args.seed))
+
+    elif args.command == 'load':
+        from benchmarks.load import run, SCENARIOS
+        scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+
+        results = run(args.base_url, args.url, scenarios, requests=args.requests, concurrency=args.concurrency,
+                      warmup=args.warmup, random_seed=args.seed)
+        report.write_results('load', {'base_url': args.base_url, 'requests': args.requests, 'concurrency': args.concurrency,
+                                      'warmup': args.warmup, 'seed': args.seed}, results, args.out)
+
+    elif args.command == 'micro':
+        from benchmarks.micro import composition, serialization, bcrypt
+        results = {**composition(args.url, args.number), **serialization(), **bcrypt(args.bcrypt_number)}
+        report.write_results('micro', {'number': args.number, 'bcrypt_number': args.bcrypt_number}, results, args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection, HTTPException
+from itertools import count
+from random import Random
+from threading import Lock
+from time import perf_counter
+from urllib.parse import urlencode, urlsplit
+from uuid import uuid4
+from psycopg2 import connect
+from benchmarks.report import summarize
+from benchmarks.seed import PASSWORD, WORDS, user_email
+
+
+class Context:
+    '''What the scenarios need to know about the seeded data, read from the DB once per run'''
+
+    def __init__(self, url: str, random_seed: int = 42):
+        self.rng = Random(random_seed)
+        self.run_id = uuid4().hex[:8]
+
+        conn = connect(url)
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("select count(*) from users where active and email like 'bench%%@example.com'")
+                self.users = cursor.fetchone()[0]
+                cursor.execute('select id from guestbook where not private order by id')
+                self.public_ids = [row[0] for row in cursor.fetchall()]
+                cursor.execute('select t.token from tokens t join users u on u.id = t.user_id where not u.active order by t.id')
+                self.tokens = [row[0] for row in cursor.fetchall()]
+        finally:
+            conn.close()
+
+        if not self.users:
+            raise SystemExit('No seeded users found, run the seed command first')
+
+        # precomputed, so a run spends its time on requests rather than on building them
+        self._auth = [{'Authorization': 'Basic ' + b64encode(f'{user_email(n)}:{PASSWORD}'.encode()).decode()}
+                      for n in range(self.users)]
+
+    def auth(self, i: int):
+        return self._auth[i % self.users]
+
+
+FORM = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+
+# each scenario builds the i-th request of a run: (method, path, body, headers)
+def register(ctx: Context, i: int):
+    query = urlencode({'email': f'load-{ctx.run_id}-{i}@example.com', 'password': PASSWORD})
+    return 'POST', f'/register?{query}', None, {}
+
+
+def activate(ctx: Context, i: int):
+    # every token activates once, so a run needs at least as many pending users as requests
+    return 'GET', f'/activate?token={ctx.tokens[i % len(ctx.tokens)]}', None, {}
+
+
+def post(ctx: Context, i: int):
+    body = urlencode({'message': ' '.join(ctx.rng.choice(WORDS) for _ in range(8)), 'private': 'false'})
+    return 'POST', '/messages', body, {**ctx.auth(i), **FORM}
+
+
+def search(ctx: Context, i: int):
+    return 'GET', f'/messages/search?{urlencode({"search_pattern": ctx.rng.choice(WORDS), "num": 10})}', None, ctx.auth(i)
+
+
+def list_messages(ctx: Context, i: int):
+    return 'GET', '/messages?num=20', None, ctx.auth(i)
+
+
+def upvote(ctx: Context, i: int):
+    return 'POST', f'/messages/{ctx.rng.choice(ctx.public_ids)}/upvote', None, ctx.auth(i)
+
+
+def most_upvoted(ctx: Context, i: int):
+    return 'GET', '/messages/most_upvoted', None, {}
+
+
+SCENARIOS = {'register': register, 'activate': activate, 'post': post, 'search': search,
+             'list': list_messages, 'upvote': upvote, 'most_upvoted': most_upvoted}
+
+
+def run_scenario(base_url: str, scenario, ctx: Context, requests: int = 1000, concurrency: int = 10, warmup: int = 0):
+    '''Sending `requests` requests of a scenario over `concurrency` keep-alive connections.
+
+        Latency is measured for every response, whatever its status; statuses are counted separately,
+        and 5xx responses or broken connections count as errors.
+    '''
+    target = urlsplit(base_url)
+    issued = count()
+    lock = Lock()
+    latencies = []
+    statuses = {}
+    errors = 0
+
+    def worker(total: int, record: bool):
+        nonlocal errors
+        conn = HTTPConnection(target.hostname, target.port or 80, timeout=30)
+        local_latencies, local_statuses, local_errors = [], {}, 0
+
+        while True:
+            with lock:
+                i = next(issued)
+            if i >= total:
+                break
+
+            method, path, body, headers = scenario(ctx, i)
+            started = perf_counter()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                response.read()
+            except (HTTPException, OSError):
+                local_errors += 1
+                conn.close()
+                conn = HTTPConnection(target.hostname, target.port or 80, timeout=30)
+                continue
+
+            local_latencies.append(perf_counter() - started)
+            local_statuses[response.status] = local_statuses.get(response.status, 0) + 1
+            if response.status >= 500:
+                local_errors += 1
+
+        conn.close()
+
+        if record:
+            with lock:
+                latencies.extend(local_latencies)
+                for code, n in local_statuses.items():
+                    statuses[code] = statuses.get(code, 0) + n
+                errors += local_errors
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        if warmup:
+            list(executor.map(lambda _: worker(warmup, False), range(concurrency)))
+            issued = count(warmup)
+            requests += warmup
+
+        started = perf_counter()
+        list(executor.map(lambda _: worker(requests, True), range(concurrency)))
+        elapsed = perf_counter() - started
+
+    return {**summarize(latencies, elapsed), 'concurrency': concurrency, 'errors': errors,
+            'statuses': {str(code): n for code, n in sorted(statuses.items())}}
+
+
+def run(base_url: str, url: str, scenarios: list[str], requests: int = 1000, concurrency: int = 10, warmup: int = 0,
+        random_seed: int = 42):
+    '''Running scenarios one after another against a running API, results keyed by scenario name'''
+    ctx = Context(url, random_seed)
+    results = {}
+
+    for name in scenarios:
+        print(f'{name}: {requests} requests, concurrency {concurrency}')
+        results[name] = run_scenario(base_url, SCENARIOS[name], ctx, requests, concurrency, warmup)
+
+    return results
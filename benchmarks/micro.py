@@ -0,0 +1,96 @@
+from asyncio import gather, run as run_async
+from datetime import datetime
+import json
+from statistics import median
+from time import perf_counter
+from psycopg2 import connect
+from db import Database
+from fastapi.encoders import jsonable_encoder
+from hashing import PasswordHasher
+from utils import get_psw_hash, verify_psw, as_dicts, json_bytes
+
+
+def measure(func, number: int, repeat: int = 5):
+    '''Timing `number` calls of func `repeat` times, per call figures of the best and the median repetition'''
+    times = []
+    for _ in range(repeat):
+        started = perf_counter()
+        for _ in range(number):
+            func()
+        times.append((perf_counter() - started) / number)
+
+    best = min(times)
+    return {'number': number, 'repeat': repeat,
+            'median_us': round(median(times) * 1e6, 3),
+            'best_us': round(best * 1e6, 3),
+            'ops_per_second': round(1 / median(times), 1)}
+
+
+# the shapes the routers actually use
+QUERIES = {
+    'get_by_id': dict(table='guestbook', columns=['id', 'user_id', 'message', 'created_at', 'private'], limit=1, where={'id': 1}),
+    'list_page': dict(table='guestbook', columns=['id', 'message', 'created_at'], limit=20,
+                      where={'private': False}, or_where={'user_id': 1},
+                      order_by=['created_at', 'id'], desc=True, after=['2024-01-01', 100]),
+}
+
+
+def composition(url: str, number: int = 10000):
+    '''Composing and rendering statements from scratch vs. getting them from the statement templates'''
+    db = Database()
+    # rendering identifiers needs a connection (for its encoding), nothing is executed
+    db.conn = connect(url)
+    results = {}
+
+    try:
+        for name, kwargs in QUERIES.items():
+            results[f'compose_{name}'] = measure(lambda: db._compose_get(**kwargs).as_string(db.conn), number)
+            results[f'template_{name}'] = measure(lambda: db._get_statement(**kwargs), number)
+
+        search_args = dict(table='guestbook', columns=['id', 'message', 'created_at'], search='hello world',
+                           vector='message_tsv', limit=10, where={'private': False}, or_where={'user_id': 1})
+        results['compose_search'] = measure(
+            lambda: db._compose_search('guestbook', search_args['columns'], 'message_tsv', 10,
+                                       search_args['where'], search_args['or_where']).as_string(db.conn), number)
+        results['template_search'] = measure(lambda: db._search_statement(**search_args), number)
+    finally:
+        db.conn.close()
+
+    return results
+
+
+def serialization(number: int = 1000, rows: int = 100):
+    '''Rendering a page of messages: dict rows through jsonable_encoder and json vs. tuple rows through orjson'''
+    columns = ['id', 'message', 'created_at']
+    tuples = [(n, f'a guestbook message number {n}', datetime(2024, 1, 1, 12, 0, n % 60, 123456)) for n in range(rows)]
+    dicts = as_dicts(tuples, columns)
+
+    return {'render_dict_rows': measure(lambda: json.dumps(jsonable_encoder({'messages': dicts}), ensure_ascii=False,
+                                                           separators=(',', ':')).encode('utf-8'), number),
+            'render_tuple_rows': measure(lambda: json_bytes({'messages': as_dicts(tuples, columns)}), number)}
+
+
+def bcrypt(number: int = 20, concurrency: int = 8):
+    '''bcrypt hashing and verification inline, and verification throughput on the hashing process pool'''
+    hashed = get_psw_hash('benchpass1')
+    results = {'bcrypt_hash': measure(lambda: get_psw_hash('benchpass1'), number, repeat=3),
+               'bcrypt_verify': measure(lambda: verify_psw('benchpass1', hashed), number, repeat=3)}
+
+    hasher = PasswordHasher(max_queue=number * concurrency)
+
+    async def verify_batch():
+        await gather(*(hasher.verify('benchpass1', hashed) for _ in range(concurrency)))
+
+    try:
+        run_async(verify_batch())  # spawning the workers outside of the timing
+        started = perf_counter()
+        for _ in range(number):
+            run_async(verify_batch())
+        elapsed = perf_counter() - started
+    finally:
+        hasher.shutdown()
+
+    results['bcrypt_verify_pool'] = {'number': number * concurrency, 'concurrency': concurrency,
+                                     'ops_per_second': round(number * concurrency / elapsed, 1),
+                                     'mean_us': round(elapsed / (number * concurrency) * 1e6, 3)}
+    return results
@@ -0,0 +1,87 @@
+from datetime import datetime, timezone
+from subprocess import run, DEVNULL
+import json
+from math import ceil
+import platform
+import sys
+
+
+def percentile(sorted_values: list, p: float):
+    '''The nearest-rank p-th percentile of already sorted values'''
+    if not sorted_values:
+        return None
+    # p * n first, p / 100 isn't exact in floating point and could push the rank up one
+    rank = max(ceil(p * len(sorted_values) / 100), 1)
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(latencies: list, elapsed: float):
+    '''Throughput and latency percentiles (in ms) of a run that took `elapsed` seconds'''
+    latencies = sorted(latencies)
+    ms = lambda v: round(v * 1000, 3) if v is not None else None
+
+    return {'count': len(latencies),
+            'elapsed': round(elapsed, 3),
+            'throughput': round(len(latencies) / elapsed, 2) if elapsed else None,
+            'mean_ms': ms(sum(latencies) / len(latencies)) if latencies else None,
+            'p50_ms': ms(percentile(latencies, 50)),
+            'p95_ms': ms(percentile(latencies, 95)),
+            'p99_ms': ms(percentile(latencies, 99)),
+            'max_ms': ms(latencies[-1]) if latencies else None}
+
+
+def _git_commit():
+    try:
+        result = run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, stdin=DEVNULL)
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def write_results(kind: str, params: dict, results: dict, out: str = None):
+    '''Saving results as JSON along with what's needed to compare runs: the commit, the interpreter and the parameters'''
+    document = {'kind': kind,
+                'started_at': datetime.now(timezone.utc).isoformat(),
+                'git_commit': _git_commit(),
+                'python': sys.version.split()[0],
+                'platform': platform.platform(),
+                'params': params,
+                'results': results}
+
+    text = json.dumps(document, indent=2)
+    if out:
+        with open(out, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    return document
+
+
+# the metrics worth comparing across runs, and whether a bigger value is better
+COMPARED = {'throughput': True, 'ops_per_second': True, 'p50_ms': False, 'p95_ms': False, 'p99_ms': False,
+            'median_us': False, 'median_ms': False, 'mean_us': False, 'mean_ms': False}
+
+
+def compare(baseline_path: str, current_path: str):
+    '''Printing the change of each benchmark's key metrics between two result files'''
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(current_path) as f:
+        current = json.load(f)
+
+    print(f"{baseline.get('git_commit') or '?'}  ->  {current.get('git_commit') or '?'}")
+
+    for name, result in current['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+
+        for metric, higher_is_better in COMPARED.items():
+            old, new = before.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+
+            change = (new - old) / old * 100
+            better = change > 0 if higher_is_better else change < 0
+            print(f'{name:<28} {metric:<15} {old:>12} {new:>12} {change:>+8.1f}% {"better" if better else "worse" if change else ""}')
@@ -0,0 +1,90 @@
+from random import Random
+from uuid import UUID
+from psycopg2 import connect
+from psycopg2.extras import execute_values
+from migrate import Migrator
+from utils import get_psw_hash
+
+# every seeded user signs in with this password
+PASSWORD = 'benchpass1'
+
+WORDS = ('guest', 'book', 'hello', 'world', 'postgres', 'fastapi', 'python', 'async', 'index', 'query',
+         'cache', 'message', 'upvote', 'search', 'keyset', 'cursor', 'pool', 'latency', 'throughput', 'kyiv')
+
+
+def user_email(n: int):
+    return f'bench{n}@example.com'
+
+
+def create_schema(url: str, reset: bool = False):
+    '''Applying ddl.sql and the migrations, after dropping everything in the public schema when `reset` is set'''
+    if reset:
+        conn = connect(url)
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('drop schema public cascade; create schema public;')
+            conn.commit()
+        finally:
+            conn.close()
+
+    migrator = Migrator(url)
+    try:
+        migrator.migrate()
+    finally:
+        migrator.close()
+
+
+def seed(url: str, users: int = 100, messages: int = 1000, upvotes: int = 5000, pending: int = 100,
+         private_ratio: float = 0.2, random_seed: int = 42):
+    '''Filling an empty schema with the same data for the same arguments:
+        `users` active users, `pending` inactive ones with activation tokens, messages by random users
+        (some of them private) and upvotes of random public messages by users other than their authors.
+    '''
+    rng = Random(random_seed)
+    # hashing once, bcrypt for every user would take minutes
+    hashed_password = get_psw_hash(PASSWORD)
+
+    conn = connect(url)
+    try:
+        with conn.cursor() as cursor:
+            user_ids = [row[0] for row in execute_values(
+                cursor, 'insert into users (email, password, active, activated_at) values %s returning id',
+                [(user_email(n), hashed_password, True, 'now()') for n in range(users)], page_size=1000, fetch=True)]
+
+            pending_ids = [row[0] for row in execute_values(
+                cursor, 'insert into users (email, password) values %s returning id',
+                [(f'pending{n}@example.com', hashed_password) for n in range(pending)], page_size=1000, fetch=True)]
+            execute_values(cursor, 'insert into tokens (token, user_id) values %s',
+                           [(str(UUID(int=rng.getrandbits(128), version=4)), user_id) for user_id in pending_ids],
+                           page_size=1000)
+
+            rows = []
+            for n in range(messages):
+                text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+                # spreading messages over the last 30 days, so pagination walks a realistic created_at range
+                rows.append((text, rng.choice(user_ids), rng.random() < private_ratio, f'{rng.randint(0, 30 * 86400)} seconds'))
+            messages_db = execute_values(
+                cursor, 'insert into guestbook (message, user_id, private, created_at) '
+                        'select v.message, v.user_id, v.private, now() - v.age::interval from (values %s) as v (message, user_id, private, age) '
+                        'returning id, user_id, private',
+                rows, page_size=1000, fetch=True)
+
+            public = [(message_id, author) for message_id, author, private in messages_db if not private]
+            pairs = set()
+            if public and len(user_ids) > 1:
+                for _ in range(upvotes * 10):
+                    if len(pairs) >= upvotes:
+                        break
+                    message_id, author = rng.choice(public)
+                    user_id = rng.choice(user_ids)
+                    if user_id != author:
+                        pairs.add((user_id, message_id))
+            execute_values(cursor, 'insert into upvotes (user_id, message_id) values %s on conflict do nothing',
+                           sorted(pairs), page_size=1000)
+
+            cursor.execute('analyze')
+        conn.commit()
+    finally:
+        conn.close()
+
+    return {'users': len(user_ids), 'pending': len(pending_ids), 'messages': len(messages_db), 'upvotes': len(pairs)}
@@ -0,0 +1,39 @@
+from statistics import median
+from subprocess import run
+import sys
+
+# timing the import in a fresh interpreter, so nothing is cached in sys.modules
+TIMED_IMPORT = 'from time import perf_counter; t = perf_counter(); import {module}; print(perf_counter() - t)'
+
+
+def import_time(module: str = 'main', repeat: int = 5, top: int = 15):
+    '''How long importing the app takes in a fresh interpreter, and the modules taking the most of it'''
+    times = []
+    for _ in range(repeat):
+        result = run([sys.executable, '-c', TIMED_IMPORT.format(module=module)], capture_output=True, text=True, check=True)
+        times.append(float(result.stdout.strip().splitlines()[-1]))
+
+    # -X importtime lines: "import time: self [us] | cumulative | imported package", nested ones indented
+    result = run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output=True, text=True, check=True)
+    modules, imported, direct = 0, [], []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules += 1
+
+        # a module's line comes after those of the modules it imported
+        if depth == 1:
+            imported.append({'module': name.strip(), 'cumulative_ms': int(cumulative) / 1000})
+        elif depth == 0:
+            if name.strip() == module:
+                direct = imported
+            imported = []
+
+    return {f'import_{module}': {'repeat': repeat,
+                                 'median_ms': round(median(times) * 1000, 3),
+                                 'best_ms': round(min(times) * 1000, 3),
+                                 'modules': modules,
+                                 # the modules it imports directly, slowest first
+                                 'slowest': sorted(direct, key=lambda m: m['cumulative_ms'], reverse=True)[:top]}}
@@ -1,55 +1,466 @@
-from psycopg2 import connect, sql
+from contextlib import contextmanager
+from itertools import count
+from os import environ as env, getpid
+from threading import Condition, Lock
+from time import monotonic, perf_counter
+from weakref import WeakKeyDictionary
+from psycopg2 import connect, sql, extensions, Error
 from psycopg2.extras import RealDictCursor
-from dotenv import load_dotenv
-from os import environ as env
+from replicas import ReplicaSet, LAG_QUERY
+
+
+class PoolExhausted(Exception):
+    '''Raised when no pooled connection became available within the pool timeout'''
+
+
+class ConnectionPool:
+    '''A per-process pool of DB connections.
+
+        Connections are health-checked on checkout, recycled after max_uses checkouts or max_age seconds,
+        and borrowers wait at most `timeout` seconds for a free connection before PoolExhausted is raised.
+    '''
+
+    def __init__(self, url: str, minconn: int = 1, maxconn: int = 10, timeout: float = 5.0,
+                 max_uses: int = 0, max_age: float = 0, check_idle: float = 30.0):
+        self.url = url
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_uses = max_uses
+        self.max_age = max_age
+        self.check_idle = check_idle
+
+        self._idle = []  # LIFO, so the most recently used (warm) connection is handed out first
+        self._meta = {}  # id(conn) -> {'created': ..., 'uses': ..., 'last_used': ...}
+        self._size = 0  # idle + borrowed connections
+        self._cond = Condition()
+
+        for _ in range(minconn):
+            self._idle.append(self._connect())
+            self._size += 1
+
+    def _connect(self):
+        conn = connect(self.url)
+        now = monotonic()
+        self._meta[id(conn)] = {'created': now, 'uses': 0, 'last_used': now}
+        return conn
+
+    def _drop(self, conn):
+        self._meta.pop(id(conn), None)
+        try:
+            conn.close()
+        except Error:
+            pass
+
+    def _expired(self, conn):
+        meta = self._meta[id(conn)]
+        if self.max_uses and meta['uses'] >= self.max_uses:
+            return True
+        return bool(self.max_age) and monotonic() - meta['created'] >= self.max_age
+
+    def _healthy(self, conn):
+        '''Cheap checks first, a round trip only for connections that have been idle for a while'''
+        if conn.closed or self._expired(conn):
+            return False
+
+        if monotonic() - self._meta[id(conn)]['last_used'] < self.check_idle:
+            return True
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('select 1')
+            conn.rollback()
+            return True
+        except Error:
+            return False
+
+    def getconn(self, timeout: float = None):
+        '''Borrowing a healthy connection, waiting up to `timeout` (by default the pool's) seconds for one to be returned'''
+        timeout = self.timeout if timeout is None else timeout
+        deadline = monotonic() + timeout
+
+        with self._cond:
+            while not self._idle and self._size >= self.maxconn:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise PoolExhausted(
+                        f'No DB connection became available in {timeout}s (pool size {self.maxconn})')
+                self._cond.wait(remaining)
+
+            # either take an idle connection or reserve a slot for a new one
+            conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                self._size += 1
+
+        try:
+            if conn is not None and not self._healthy(conn):
+                self._drop(conn)
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+        return conn
+
+    def putconn(self, conn):
+        '''Returning a borrowed connection, rolling back whatever the borrower left open'''
+        meta = self._meta.get(id(conn))
+        keep = meta is not None and not conn.closed
+
+        if keep:
+            meta['uses'] += 1
+            meta['last_used'] = monotonic()
+            status = conn.get_transaction_status()
+
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN or self._expired(conn):
+                keep = False
+            elif status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except Error:
+                    keep = False
+
+        if not keep:
+            self._drop(conn)
+
+        with self._cond:
+            if keep:
+                self._idle.append(conn)
+            else:
+                self._size -= 1
+            self._cond.notify()
+
+    def metrics(self):
+        with self._cond:
+            return {'size': self._size, 'idle': len(self._idle), 'in_use': self._size - len(self._idle),
+                    'maxconn': self.maxconn}
+
+    def closeall(self):
+        with self._cond:
+            while self._idle:
+                self._drop(self._idle.pop())
+                self._size -= 1
+
+
+_pools = {}
+_pools_pid = None
+# threads first touching a url at the same time would each create a pool, all but one of them leaked
+_pools_lock = Lock()
+
+
+def get_pool(url: str = None):
+    '''Getting (lazily creating) this process's pool for a DB url; pools are never shared across a fork'''
+    global _pools_pid
+
+    url = url or env.get('CONNECTION_URL')
+    if _pools_pid == getpid() and url in _pools:
+        return _pools[url]
+
+    with _pools_lock:
+        if _pools_pid != getpid():
+            _pools.clear()
+            _pools_pid = getpid()
+
+        if url not in _pools:
+            _pools[url] = ConnectionPool(
+                url,
+                minconn=int(env.get('DB_POOL_MIN', 1)),
+                maxconn=int(env.get('DB_POOL_MAX', 10)),
+                timeout=float(env.get('DB_POOL_TIMEOUT', 5)),
+                max_uses=int(env.get('DB_POOL_MAX_USES', 0)),
+                max_age=float(env.get('DB_POOL_MAX_AGE', 1800)),
+                check_idle=float(env.get('DB_POOL_CHECK_IDLE', 30))
+            )
+
+        return _pools[url]
+
+
+def close_pools():
+    '''Closing this process's pools, once nothing borrows from them any more'''
+    with _pools_lock:
+        if _pools_pid == getpid():
+            while _pools:
+                _, pool = _pools.popitem()
+                pool.closeall()
+
+
+def pool_metrics():
+    '''Sizes of this process's pools (urls are left out, they carry credentials)'''
+    return [pool.metrics() for pool in _pools.values()] if _pools_pid == getpid() else []
+
 
-load_dotenv()
+# per connection: executions so far of each query shape, or its statement name once it's been PREPAREd
+_prepared = WeakKeyDictionary()
 
 
 class Database:
     '''A more generic DB helper'''
 
+    # the SQL composition module used by the _compose_* methods (psycopg.sql for AsyncDatabase)
+    _sql = sql
+
+    # rendered, parameterized statements by query shape (table, columns, where/or_where/contains keys, limit presence)
+    _templates = {}
+    _statement_names = {}
+    _statement_ids = count()
+    template_stats = {'hits': 0, 'misses': 0, 'prepared': 0}
+
+    # how many executions on a connection make a query shape a server-side prepared statement, 0 to never prepare
+    prepare_threshold = int(env.get('DB_PREPARE_THRESHOLD', 5))
+
+    # an instrumentation hook (e.g. instrumentation.QueryMetrics), called as instrument.record(shape, query, elapsed, rows)
+    # after each statement, None to run statements untimed
+    instrument = None
+
+    # rows fetched per round trip by stream(), from a server-side cursor
+    stream_fetch_size = int(env.get('DB_STREAM_FETCH_SIZE', 500))
+    _stream_ids = count()
+
+    # rows per multi-row INSERT statement of write_many()
+    write_many_page_size = int(env.get('DB_WRITE_MANY_PAGE_SIZE', 100))
+
+    # read replicas (REPLICA_URLS) that reads go to when they keep up with the primary, None to read from the primary
+    replicas = ReplicaSet.from_env()
+
     def __init__(self):
         # initializing attributes
         self.conn = None
         self.cursor = None
+        self.tuple_cursor = None
+        self.pool = None
+
+        # a connection to a replica, borrowed on the first read
+        self.read_conn = None
+        self.read_cursor = None
+        self.read_tuple_cursor = None
+        self.read_pool = None
+
+        # whose reads these are (e.g. the user id), so they can be pinned to the primary after that user writes
+        self.sticky_key = None
+        # set by the first write, so reads see what this Database wrote
+        self.primary_reads = False
+
+        # how many transaction() blocks are open, writes only commit outside of them
+        self.transaction_depth = 0
 
     def open(self, url=None):
-        """Opening a connection to DB"""
-        if not url:
-            url = env.get('CONNECTION_URL')
-        self.conn = connect(url)
+        """Borrowing a connection to DB from the process pool"""
+        self.pool = get_pool(url)
+        self.conn = self.pool.getconn()
         self.cursor = self.conn.cursor(cursor_factory=RealDictCursor)
 
     def close(self):
-        self.cursor.close()
-        self.conn.close()
-
-    @staticmethod
-    def _compose_kv_and(separator=' AND ', joiner=' = ', kv_pairs=None):
+        """Giving the connection back to the pool"""
+        if self.cursor:
+            self.cursor.close()
+        if self.tuple_cursor:
+            self.tuple_cursor.close()
+        if self.conn:
+            self.pool.putconn(self.conn)
+        self.conn = None
+        self.cursor = None
+        self.tuple_cursor = None
+
+        if self.read_cursor:
+            self.read_cursor.close()
+        if self.read_tuple_cursor:
+            self.read_tuple_cursor.close()
+        if self.read_conn:
+            self.read_pool.putconn(self.read_conn)
+        self.read_conn = None
+        self.read_cursor = None
+        self.read_tuple_cursor = None
+
+    def _use_replica(self):
+        '''Whether reads go to a replica, borrowing a connection to one that keeps up with the primary on the first read'''
+        if self.replicas is None or self.primary_reads or self.replicas.pinned(self.sticky_key):
+            return False
+
+        if self.read_conn is not None:
+            return True
+
+        for url in self.replicas.candidates():
+            try:
+                # a new pool connects right away, so a replica that's down fails here
+                pool = get_pool(url)
+                conn = pool.getconn(timeout=self.replicas.timeout)
+            except PoolExhausted:
+                continue
+            except Error:
+                self.replicas.failed(url)
+                continue
+
+            if self.replicas.due(url):
+                try:
+                    with conn.cursor() as cursor:
+                        cursor.execute(LAG_QUERY)
+                        lag = cursor.fetchone()[0]
+                    conn.rollback()
+                except Error:
+                    pool.putconn(conn)
+                    self.replicas.failed(url)
+                    continue
+
+                if not self.replicas.checked(url, lag):
+                    pool.putconn(conn)
+                    continue
+
+            self.read_pool = pool
+            self.read_conn = conn
+            self.read_cursor = conn.cursor(cursor_factory=RealDictCursor)
+            return True
+
+        return False
+
+    def _cursor(self, as_tuples: bool = False, read: bool = False):
+        '''The dict cursor, or a plain one (opened on first use) whose rows are tuples in column order.
+            With READ it's a cursor on a replica, if reads can go to one.
+        '''
+        if read and self.replicas is not None:
+            if self._use_replica():
+                self.replicas.stats['replica_reads'] += 1
+                if not as_tuples:
+                    return self.read_cursor
+                if self.read_tuple_cursor is None:
+                    self.read_tuple_cursor = self.read_conn.cursor()
+                return self.read_tuple_cursor
+            self.replicas.stats['primary_reads'] += 1
+
+        if not as_tuples:
+            return self.cursor
+        if self.tuple_cursor is None:
+            self.tuple_cursor = self.conn.cursor()
+        return self.tuple_cursor
+
+    @contextmanager
+    def transaction(self, synchronous_commit: bool = True):
+        '''Grouping the writes of a with block into one transaction: a single commit at its end, or a rollback if it raises.
+            A nested block is a savepoint, undone on its own if it raises.
+            SYNCHRONOUS_COMMIT=False doesn't wait for the commit to reach the disk, for writes that are fine to lose in a crash
+            (it's up to the outermost block).
+        '''
+        if self.transaction_depth:
+            savepoint = f'gb_savepoint_{self.transaction_depth}'
+            self.cursor.execute(f'savepoint {savepoint}')
+            self.transaction_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self.cursor.execute(f'rollback to savepoint {savepoint}')
+                raise
+            else:
+                self.cursor.execute(f'release savepoint {savepoint}')
+            finally:
+                self.transaction_depth -= 1
+            return
+
+        self.transaction_depth = 1
+        try:
+            if not synchronous_commit:
+                self.cursor.execute('set local synchronous_commit to off')
+            yield self
+        except BaseException:
+            self.conn.rollback()
+            raise
+        else:
+            self.conn.commit()
+        finally:
+            self.transaction_depth = 0
+
+    def _commit(self):
+        '''Committing a write, unless it's in a transaction() block (which commits once, at its end)'''
+        if not self.transaction_depth:
+            self.conn.commit()
+
+    def _wrote(self):
+        '''Sending the reads that follow a write to the primary: this Database's, and its sticky key's for a while'''
+        self.primary_reads = True
+        if self.replicas is not None:
+            self.replicas.pin(self.sticky_key)
+
+    @classmethod
+    def template_metrics(cls):
+        '''Statement template cache hits and misses, and how many shapes are cached'''
+        return {**cls.template_stats, 'cached': len(cls._templates)}
+
+    @classmethod
+    def _compose_kv_and(cls, separator=' AND ', joiner=' = ', keys=None):
+        sql = cls._sql
 
         return sql.SQL(separator).join(
             sql.SQL("{}" + joiner + "{}").format(
-                sql.Identifier(k), sql.Literal(v)) for k, v in kv_pairs
+                sql.Identifier(k), sql.Placeholder()) for k in keys
         )
 
-    def get(self, table: str, columns: list[str], limit: int = None, where: dict = None, or_where: dict = None, contains: dict = None):
-        '''Getting specified number of rows from a table for specified columns with optional WHERE, OR_WHERE and CONTAINS'''
+    @staticmethod
+    def _numbered(query: str):
+        '''Turning %s placeholders into $1, $2, ... for PREPARE'''
+        parts = query.split('%s')
+        return parts[0] + ''.join(f'${i}{part}' for i, part in enumerate(parts[1:], 1))
+
+    def _statement(self, shape: tuple, compose):
+        '''Getting the rendered statement for a query shape, composing it only the first time the shape is seen'''
+        query = self._templates.get(shape)
+
+        if query is None:
+            self.template_stats['misses'] += 1
+            query = self._templates[shape] = compose().as_string(self.conn)
+        else:
+            self.template_stats['hits'] += 1
+
+        return query
+
+    def _execute(self, shape: tuple, query: str, params: list, cursor=None):
+        '''Executing a statement, promoting its shape to a prepared statement once it's hot on this connection'''
+        cursor = cursor or self.cursor
+        statement = query
+
+        if self.prepare_threshold:
+            prepared = _prepared.setdefault(cursor.connection, {})
+            state = prepared.get(shape, 0)
+
+            if not isinstance(state, str):
+                state += 1
+                if state >= self.prepare_threshold:
+                    # numbered from a counter, the len() of the dict could hand two threads the same name
+                    name = self._statement_names.setdefault(shape, f'gb_stmt_{next(self._statement_ids)}')
+                    cursor.execute(f'prepare {name} as {self._numbered(query)}')
+                    self.template_stats['prepared'] += 1
+                    state = name
+                prepared[shape] = state
+
+            if isinstance(state, str):
+                statement = f"execute {state} ({','.join(['%s'] * len(params))})" if params else f'execute {state}'
+
+        if self.instrument is None:
+            cursor.execute(statement, params)
+            return
+
+        started = perf_counter()
+        cursor.execute(statement, params)
+        self.instrument.record(shape, query, perf_counter() - started, cursor.rowcount)
+
+    def _compose_get(self, table: str, columns: list[str], limit: int = None, where: dict = None, or_where: dict = None, contains: dict = None,
+                     order_by: list[str] = None, desc: bool = False, after: list = None):
+        sql = self._sql
 
         composed_query = sql.SQL("select {} from {}").format(
             sql.SQL(',').join(map(sql.Identifier, columns)),
             sql.Identifier(table)
         )
 
-        if contains:
-            transformed_contains = {
-                k: f"%{v}%" for (k, v) in contains.items()}
+        # the filters are collected first, so they can be parenthesized as a whole when a keyset predicate follows
+        filters = sql.Composed([])
 
-            composed_query += sql.SQL(" where {}").format(
-                self._compose_kv_and(separator=' or ', joiner=' like ', kv_pairs=transformed_contains.items()))
+        if contains:
+            filters += self._compose_kv_and(separator=' or ', joiner=' like ', keys=contains)
 
         if where:
-            starter = sql.SQL(" where ({})")
+            starter = sql.SQL("({})")
 
             if contains:
                 if or_where:
@@ -57,19 +468,37 @@ class Database:
                 else:
                     starter = sql.SQL(" and ({})")
 
-            composed_query += starter.format(
-                self._compose_kv_and(kv_pairs=where.items())
+            filters += starter.format(
+                self._compose_kv_and(keys=where)
             )
 
         if where and or_where:
-            composed_query += sql.SQL(" or ({})").format(
-                self._compose_kv_and(kv_pairs=or_where.items()))
+            filters += sql.SQL(" or ({})").format(
+                self._compose_kv_and(keys=or_where))
 
             if contains:
-                composed_query += sql.SQL(")")
+                filters += sql.SQL(")")
+
+        # keyset pagination: ... WHERE (order_by) < (after) ORDER BY order_by DESC, the row comparison is served by an index on order_by
+        if after:
+            keyset = sql.SQL("({}) {} ({})").format(
+                sql.SQL(',').join(map(sql.Identifier, order_by)),
+                sql.SQL('<' if desc else '>'),
+                sql.SQL(',').join(sql.Placeholder() for _ in order_by)
+            )
+            if contains or where:
+                composed_query += sql.SQL(" where ({}) and {}").format(filters, keyset)
+            else:
+                composed_query += sql.SQL(" where {}").format(keyset)
+        elif contains or where:
+            composed_query += sql.SQL(" where {}").format(filters)
+
+        if order_by:
+            composed_query += sql.SQL(" order by {}").format(
+                sql.SQL(',').join(sql.SQL("{} {}").format(sql.Identifier(k), sql.SQL('desc' if desc else 'asc')) for k in order_by))
 
         if limit:
-            composed_query += sql.SQL(' limit {}').format(sql.Literal(limit))
+            composed_query += sql.SQL(' limit {}').format(sql.Placeholder())
 
         # composed_query = sql.SQL("select {} from {}").format(
         #     sql.SQL(',').join(map(sql.Identifier, columns)),
@@ -111,10 +540,64 @@ class Database:
         # if limit:
         #     composed_query += sql.SQL(' limit {}').format(sql.Literal(limit))
 
-        print(composed_query.as_string(self.conn))
+        return composed_query
+
+    def _get_statement(self, table: str, columns: list[str], limit: int = None, where: dict = None, or_where: dict = None, contains: dict = None,
+                       order_by: list[str] = None, desc: bool = False, after: list = None):
+        or_where = or_where if where else None
+        after = after if order_by else None
+        shape = ('get', table, tuple(columns), bool(limit), tuple(where or ()), tuple(or_where or ()), tuple(contains or ()),
+                 tuple(order_by or ()), desc, bool(after))
+        query = self._statement(shape, lambda: self._compose_get(table, columns, limit, where, or_where, contains, order_by, desc, after))
+
+        # values go in the same order as their placeholders: contains, where, or_where, after, limit
+        params = [f"%{v}%" for v in contains.values()] if contains else []
+        if where:
+            params.extend(where.values())
+        if or_where:
+            params.extend(or_where.values())
+        if after:
+            params.extend(after)
+        if limit:
+            params.append(limit)
+
+        return shape, query, params
 
-        self.cursor.execute(composed_query)
-        return self.cursor.fetchall()
+    def get(self, table: str, columns: list[str], limit: int = None, where: dict = None, or_where: dict = None, contains: dict = None,
+            order_by: list[str] = None, desc: bool = False, after: list = None, as_tuples: bool = False):
+        '''Getting specified number of rows from a table for specified columns with optional WHERE, OR_WHERE and CONTAINS.
+            With ORDER_BY rows are sorted on those columns, and AFTER (their values from the last row of a page) fetches the next page.
+            AS_TUPLES gives plain tuples in column order instead of dicts, for hot paths that don't need the keys.
+        '''
+        cursor = self._cursor(as_tuples, read=True)
+        self._execute(*self._get_statement(table, columns, limit, where, or_where, contains, order_by, desc, after), cursor=cursor)
+        return cursor.fetchall()
+
+    def stream(self, table: str, columns: list[str], where: dict = None, or_where: dict = None, contains: dict = None,
+               order_by: list[str] = None, desc: bool = False, fetch_size: int = None):
+        '''Like get, but reading through a server-side cursor and yielding the rows in batches of `fetch_size`,
+            so only one batch at a time is held in memory however many rows there are.
+            The cursor lives in a transaction that stays open until the generator is exhausted or closed.
+        '''
+        shape, query, params = self._get_statement(table, columns, None, where, or_where, contains, order_by, desc, None)
+        fetch_size = fetch_size or self.stream_fetch_size
+
+        started = perf_counter()
+        rows = 0
+        conn = self._cursor(read=True).connection
+        cursor = conn.cursor(name=f'gb_stream_{next(self._stream_ids)}', cursor_factory=RealDictCursor)
+        try:
+            cursor.execute(query, params)
+            while True:
+                batch = cursor.fetchmany(fetch_size)
+                if not batch:
+                    break
+                rows += len(batch)
+                yield batch
+        finally:
+            cursor.close()
+            if self.instrument is not None:
+                self.instrument.record(shape, query, perf_counter() - started, rows)
 
     def get_one(self, table: str, columns: list[str], where: dict = None):
         '''Getting a single row in a form of dict from a table for specified columns with optional WHERE'''
@@ -122,8 +605,8 @@ class Database:
         if len(result):
             return result[0]  # {}
 
-    def get_contains(self, table: str, columns: list[str], search: str, limit: int = None):
-        '''Getting records where a search term is present in specified columns'''
+    def _compose_get_contains(self, table: str, columns: list[str], search: str, limit: int = None):
+        sql = self._sql
 
         # ... WHERE col1 LIKE %search% OR col2 LIKE %search%
         composed_query = sql.SQL("select {} from {} where {}").format(
@@ -131,18 +614,91 @@ class Database:
             sql.Identifier(table),
             sql.SQL(' or ').join(
                 sql.SQL('{} like {}').format(
-                    sql.Identifier(k), sql.Literal(f"%{search}%")) for k in columns
+                    sql.Identifier(k), sql.Placeholder()) for k in columns
             )
         )
 
         if limit:
-            composed_query += sql.SQL(' limit {}').format(sql.Literal(limit))
+            composed_query += sql.SQL(' limit {}').format(sql.Placeholder())
 
-        self.cursor.execute(composed_query)
-        return self.cursor.fetchall()
+        return composed_query
 
-    def write(self, table: str, columns: list[str], values: list):
-        '''Writing into a table an arbitrary number of values'''
+    def _get_contains_statement(self, table: str, columns: list[str], search: str, limit: int = None):
+        shape = ('get_contains', table, tuple(columns), bool(limit))
+        query = self._statement(shape, lambda: self._compose_get_contains(table, columns, search, limit))
+        params = [f"%{search}%"] * len(columns) + ([limit] if limit else [])
+        return shape, query, params
+
+    def get_contains(self, table: str, columns: list[str], search: str, limit: int = None):
+        '''Getting records where a search term is present in specified columns'''
+        cursor = self._cursor(read=True)
+        self._execute(*self._get_contains_statement(table, columns, search, limit), cursor=cursor)
+        return cursor.fetchall()
+
+    def _compose_search(self, table: str, columns: list[str], vector: str, limit: int = None, where: dict = None, or_where: dict = None, after: list = None):
+        sql = self._sql
+
+        # ... FROM table, websearch_to_tsquery(config, search) search_query WHERE vector @@ search_query AND ((where) OR (or_where))
+        composed_query = sql.SQL(
+            "select {}, ts_rank({}, search_query) as rank from {}, websearch_to_tsquery({}::regconfig, {}) as search_query where {} @@ search_query"
+        ).format(
+            sql.SQL(',').join(map(sql.Identifier, columns)),
+            sql.Identifier(vector),
+            sql.Identifier(table),
+            sql.Placeholder(),
+            sql.Placeholder(),
+            sql.Identifier(vector)
+        )
+
+        # unlike get, the filters are grouped so the match applies to both where and or_where rows
+        if where:
+            composed_query += sql.SQL(" and (({})").format(self._compose_kv_and(keys=where))
+            if or_where:
+                composed_query += sql.SQL(" or ({})").format(self._compose_kv_and(keys=or_where))
+            composed_query += sql.SQL(")")
+
+        # keyset pagination over (rank, id), rank is a real so the cursor value is compared as one
+        if after:
+            composed_query += sql.SQL(" and (ts_rank({}, search_query), {}) < ({}::real, {})").format(
+                sql.Identifier(vector), sql.Identifier('id'), sql.Placeholder(), sql.Placeholder())
+
+        composed_query += sql.SQL(" order by rank desc, {} desc").format(sql.Identifier('id'))
+
+        if limit:
+            composed_query += sql.SQL(' limit {}').format(sql.Placeholder())
+
+        return composed_query
+
+    def _search_statement(self, table: str, columns: list[str], search: str, vector: str, config: str = 'simple',
+                          limit: int = None, where: dict = None, or_where: dict = None, after: list = None):
+        or_where = or_where if where else None
+        shape = ('search', table, tuple(columns), vector, bool(limit), tuple(where or ()), tuple(or_where or ()), bool(after))
+        query = self._statement(shape, lambda: self._compose_search(table, columns, vector, limit, where, or_where, after))
+
+        params = [config, search]
+        if where:
+            params.extend(where.values())
+        if or_where:
+            params.extend(or_where.values())
+        if after:
+            params.extend(after)
+        if limit:
+            params.append(limit)
+
+        return shape, query, params
+
+    def search(self, table: str, columns: list[str], search: str, vector: str, config: str = 'simple',
+               limit: int = None, where: dict = None, or_where: dict = None, after: list = None, as_tuples: bool = False):
+        '''Full-text searching a table through its indexed tsvector column, best matches first (with a rank column).
+            Optional WHERE and OR_WHERE are matched together, i.e. ... AND ((where) OR (or_where)),
+            AFTER is the (rank, id) of the last row of a previous page, AS_TUPLES is as in get (rank comes last).
+        '''
+        cursor = self._cursor(as_tuples, read=True)
+        self._execute(*self._search_statement(table, columns, search, vector, config, limit, where, or_where, after), cursor=cursor)
+        return cursor.fetchall()
+
+    def _compose_write(self, table: str, columns: list[str]):
+        sql = self._sql
 
         composed_query = sql.SQL("""
             insert into {} ({})
@@ -150,25 +706,67 @@ class Database:
         """).format(
             sql.Identifier(table),
             sql.SQL(',').join(map(sql.Identifier, columns)),
-            sql.SQL(',').join(map(sql.Literal, values))
+            sql.SQL(',').join(sql.Placeholder() for _ in columns)
         )
 
-        self.cursor.execute(composed_query)
-        self.conn.commit()
+        return composed_query
+
+    def _write_statement(self, table: str, columns: list[str], values: list):
+        shape = ('write', table, tuple(columns))
+        return shape, self._statement(shape, lambda: self._compose_write(table, columns)), list(values)
+
+    def write(self, table: str, columns: list[str], values: list):
+        '''Writing into a table an arbitrary number of values'''
+        self._execute(*self._write_statement(table, columns, values))
+        self._commit()
+        self._wrote()
         return self.cursor.fetchone().get('id')
 
-    def update(self, table: str, columns: list[str], values: list, where: dict = None):
-        '''Updating an arbitrary number of columns with values, with optional WHERE.
-            Returning a number of affected rows.
+    def _compose_write_many(self, table: str, columns: list[str], n_rows: int):
+        sql = self._sql
+        row = sql.SQL('({})').format(sql.SQL(',').join(sql.Placeholder() for _ in columns))
+
+        composed_query = sql.SQL("""
+            insert into {} ({})
+            values {} returning id;
+        """).format(
+            sql.Identifier(table),
+            sql.SQL(',').join(map(sql.Identifier, columns)),
+            sql.SQL(',').join(row for _ in range(n_rows))
+        )
+
+        return composed_query
+
+    def _write_many_statements(self, table: str, columns: list[str], rows: list):
+        '''A statement per page of rows: full pages share one shape, only a last partial page has one of its own'''
+        page_size = self.write_many_page_size
+        for start in range(0, len(rows), page_size):
+            page = rows[start:start + page_size]
+            shape = ('write_many', table, tuple(columns), len(page))
+            query = self._statement(shape, lambda: self._compose_write_many(table, columns, len(page)))
+            yield shape, query, [value for row in page for value in row]
+
+    def write_many(self, table: str, columns: list[str], rows: list):
+        '''Writing many rows of values into a table with multi-row INSERTs, committed once.
+            Returning the ids of the rows in the order they were given.
         '''
+        ids = []
+        for statement in self._write_many_statements(table, columns, rows):
+            self._execute(*statement)
+            ids += [row.get('id') for row in self.cursor.fetchall()]
+        self._commit()
+        self._wrote()
+        return ids
+
+    def _compose_update(self, table: str, columns: list[str], where: dict = None):
+        sql = self._sql
 
         # using a generator of tuples (mapping is possible as an alternative)
         # set_clause = sql.SQL(' , ').join(
         #     sql.SQL(' {} = {} ').format(
         #         sql.Identifier(column), sql.Literal(value)) for column, value in zip(columns, values)
         # )
-        set_clause = self._compose_kv_and(
-            separator=',', kv_pairs=zip(columns, values))
+        set_clause = self._compose_kv_and(separator=',', keys=columns)
 
         query = sql.SQL("""
             update {}
@@ -179,19 +777,53 @@ class Database:
         # we could have re-factored this out and use across other methods (get, update, etc)
         if where:
             query += sql.SQL(' where {}').format(
-                self._compose_kv_and(kv_pairs=where.items())
+                self._compose_kv_and(keys=where)
                 #     sql.SQL(' and ').join(
                 #     map(lambda x: sql.SQL('{} = {}').format(
                 #         sql.Identifier(x), sql.Literal(where.get(x))), where)
                 # )
             )
 
-        # return query
-        self.cursor.execute(query)
-        self.conn.commit()
+        return query
+
+    def _update_statement(self, table: str, columns: list[str], values: list, where: dict = None):
+        shape = ('update', table, tuple(columns), tuple(where or ()))
+        query = self._statement(shape, lambda: self._compose_update(table, columns, where))
+        return shape, query, list(values) + (list(where.values()) if where else [])
+
+    def update(self, table: str, columns: list[str], values: list, where: dict = None):
+        '''Updating an arbitrary number of columns with values, with optional WHERE.
+            Returning a number of affected rows.
+        '''
+        self._execute(*self._update_statement(table, columns, values, where))
+        self._commit()
+        self._wrote()
         return self.cursor.rowcount
 
-    def delete(self, table: str, where: dict = None):
+    def _compose_call(self, function: str, n_args: int):
+        sql = self._sql
+
+        return sql.SQL("select * from {}({})").format(
+            sql.Identifier(function),
+            sql.SQL(',').join(sql.Placeholder() for _ in range(n_args))
+        )
+
+    def _call_statement(self, function: str, args: list):
+        shape = ('call', function, len(args))
+        return shape, self._statement(shape, lambda: self._compose_call(function, len(args))), list(args)
+
+    def call(self, function: str, args: list):
+        '''Calling a DB function and committing whatever it changed, returning its rows
+            (a scalar function gives one row, with the value under the function name)
+        '''
+        self._execute(*self._call_statement(function, args))
+        rows = self.cursor.fetchall()
+        self._commit()
+        self._wrote()
+        return rows
+
+    def _compose_delete(self, table: str, where: dict = None):
+        sql = self._sql
 
         composed_query = sql.SQL("delete from {}").format(
             sql.Identifier(table)
@@ -199,7 +831,7 @@ class Database:
 
         if where:
             composed_query += sql.SQL(" where {}").format(
-                self._compose_kv_and(kv_pairs=where.items())
+                self._compose_kv_and(keys=where)
                 # sql.SQL(' and ').join(
                 #     sql.SQL("{} = {}").format(
                 #         sql.Identifier(k), sql.Literal(v)
@@ -207,6 +839,15 @@ class Database:
                 # )
             )
 
-        self.cursor.execute(composed_query)
-        self.conn.commit()
+        return composed_query
+
+    def _delete_statement(self, table: str, where: dict = None):
+        shape = ('delete', table, tuple(where or ()))
+        query = self._statement(shape, lambda: self._compose_delete(table, where))
+        return shape, query, list(where.values()) if where else []
+
+    def delete(self, table: str, where: dict = None):
+        self._execute(*self._delete_statement(table, where))
+        self._commit()
+        self._wrote()
         return self.cursor.rowcount
@@ -0,0 +1,337 @@
+from asyncio import Lock
+from contextlib import asynccontextmanager
+from os import environ as env
+from time import monotonic, perf_counter
+from weakref import WeakKeyDictionary
+from psycopg import sql, Error
+from psycopg.pq import TransactionStatus
+from psycopg.rows import dict_row, tuple_row
+from psycopg_pool import AsyncConnectionPool, PoolTimeout, TooManyRequests
+from db import Database
+from replicas import LAG_QUERY
+
+_pools = {}
+_pools_lock = Lock()
+
+# when each pooled connection was last given back, so only stale ones get pinged on checkout
+_last_used = WeakKeyDictionary()
+# how many times each pooled connection was borrowed, psycopg_pool only recycles them by age (DB_POOL_MAX_AGE)
+_uses = WeakKeyDictionary()
+
+
+async def _check(conn):
+    '''Pool health check, doing a round trip only for connections that have been idle for a while'''
+    if monotonic() - _last_used.get(conn, 0) >= float(env.get('DB_POOL_CHECK_IDLE', 30)):
+        await AsyncConnectionPool.check_connection(conn)
+
+
+async def get_async_pool(url: str = None):
+    '''Getting (lazily creating and opening) the event loop's pool for a DB url'''
+    url = url or env.get('CONNECTION_URL')
+
+    if url in _pools:
+        return _pools[url]
+
+    async with _pools_lock:
+        if url in _pools:
+            return _pools[url]
+
+        pool = AsyncConnectionPool(
+            url,
+            min_size=int(env.get('DB_POOL_MIN', 1)),
+            max_size=int(env.get('DB_POOL_MAX', 10)),
+            timeout=float(env.get('DB_POOL_TIMEOUT', 5)),
+            max_waiting=int(env.get('DB_POOL_MAX_WAITING', 0)),
+            max_lifetime=float(env.get('DB_POOL_MAX_AGE', 1800)),
+            check=_check,
+            kwargs={'prepare_threshold': Database.prepare_threshold or None},
+            open=False
+        )
+        await pool.open()
+        _pools[url] = pool
+
+    return pool
+
+
+def pool_metrics():
+    '''psycopg_pool's own counters for each pool (urls are left out, they carry credentials)'''
+    return [pool.get_stats() for pool in _pools.values()]
+
+
+async def close_async_pools():
+    while _pools:
+        _, pool = _pools.popitem()
+        await pool.close()
+
+
+class AsyncDatabase(Database):
+    '''An asyncio counterpart of Database, built on psycopg 3 and sharing the same dynamic SQL composition'''
+
+    _sql = sql
+
+    # psycopg 3 binds parameters server side and prepares hot statements itself (prepare_threshold)
+    _templates = {}
+    template_stats = {'hits': 0, 'misses': 0}
+
+    async def open(self, url=None):
+        """Borrowing a connection to DB from the async pool"""
+        self.pool = await get_async_pool(url)
+        self.conn = await self.pool.getconn()
+        self.cursor = self.conn.cursor(row_factory=dict_row)
+
+    async def _use_replica(self):
+        '''Whether reads go to a replica, borrowing a connection to one that keeps up with the primary on the first read'''
+        if self.replicas is None or self.primary_reads or self.replicas.pinned(self.sticky_key):
+            return False
+
+        if self.read_conn is not None:
+            return True
+
+        for url in self.replicas.candidates():
+            pool = await get_async_pool(url)
+            try:
+                conn = await pool.getconn(timeout=self.replicas.timeout)
+            except TooManyRequests:
+                continue
+            except (PoolTimeout, Error):
+                self.replicas.failed(url)
+                continue
+
+            if self.replicas.due(url):
+                try:
+                    async with conn.cursor() as cursor:
+                        await cursor.execute(LAG_QUERY)
+                        lag = (await cursor.fetchone())[0]
+                    await conn.rollback()
+                except Error:
+                    await pool.putconn(conn)
+                    self.replicas.failed(url)
+                    continue
+
+                if not self.replicas.checked(url, lag):
+                    await pool.putconn(conn)
+                    continue
+
+            self.read_pool = pool
+            self.read_conn = conn
+            self.read_cursor = conn.cursor(row_factory=dict_row)
+            return True
+
+        return False
+
+    async def _cursor(self, as_tuples: bool = False, read: bool = False):
+        '''The dict cursor, or a plain one (opened on first use) whose rows are tuples in column order.
+            With READ it's a cursor on a replica, if reads can go to one.
+        '''
+        if read and self.replicas is not None:
+            if await self._use_replica():
+                self.replicas.stats['replica_reads'] += 1
+                if not as_tuples:
+                    return self.read_cursor
+                if self.read_tuple_cursor is None:
+                    self.read_tuple_cursor = self.read_conn.cursor(row_factory=tuple_row)
+                return self.read_tuple_cursor
+            self.replicas.stats['primary_reads'] += 1
+
+        if not as_tuples:
+            return self.cursor
+        if self.tuple_cursor is None:
+            self.tuple_cursor = self.conn.cursor(row_factory=tuple_row)
+        return self.tuple_cursor
+
+    @staticmethod
+    async def _give_back(pool, conn, *cursors):
+        if not conn:
+            return
+
+        try:
+            for cursor in cursors:
+                if cursor:
+                    await cursor.close()
+            # the implicit read transaction is rolled back here, the pool would log a warning for each one;
+            # a broken connection or one still running a query (a cancelled request) is left to the pool to discard
+            if conn.info.transaction_status in (TransactionStatus.INTRANS, TransactionStatus.INERROR):
+                try:
+                    await conn.rollback()
+                except Error:
+                    pass
+            _last_used[conn] = monotonic()
+            _uses[conn] = _uses.get(conn, 0) + 1
+            max_uses = int(env.get('DB_POOL_MAX_USES', 0))
+            if max_uses and _uses[conn] >= max_uses:
+                # recycled like the sync pool's: the pool discards a closed connection and opens a new one in its place
+                await conn.close()
+        finally:
+            # whatever happened above, or the pool would be a connection short for good
+            await pool.putconn(conn)
+
+    async def close(self):
+        """Giving the connections back to their pools, rolling back an implicit read transaction if any"""
+        try:
+            await self._give_back(self.pool, self.conn, self.cursor, self.tuple_cursor)
+        finally:
+            self.conn = None
+            self.cursor = None
+            self.tuple_cursor = None
+
+            try:
+                await self._give_back(self.read_pool, self.read_conn, self.read_cursor, self.read_tuple_cursor)
+            finally:
+                self.read_conn = None
+                self.read_cursor = None
+                self.read_tuple_cursor = None
+
+    @asynccontextmanager
+    async def transaction(self, synchronous_commit: bool = True):
+        '''Grouping the writes of an async with block into one transaction: a single commit at its end, or a rollback if it raises.
+            A nested block is a savepoint, undone on its own if it raises.
+            SYNCHRONOUS_COMMIT=False doesn't wait for the commit to reach the disk, for writes that are fine to lose in a crash
+            (it's up to the outermost block).
+        '''
+        if self.transaction_depth:
+            savepoint = f'gb_savepoint_{self.transaction_depth}'
+            await self.cursor.execute(f'savepoint {savepoint}')
+            self.transaction_depth += 1
+            try:
+                yield self
+            except BaseException:
+                await self.cursor.execute(f'rollback to savepoint {savepoint}')
+                raise
+            else:
+                await self.cursor.execute(f'release savepoint {savepoint}')
+            finally:
+                self.transaction_depth -= 1
+            return
+
+        self.transaction_depth = 1
+        try:
+            if not synchronous_commit:
+                await self.cursor.execute('set local synchronous_commit to off')
+            yield self
+        except BaseException:
+            await self.conn.rollback()
+            raise
+        else:
+            await self.conn.commit()
+        finally:
+            self.transaction_depth = 0
+
+    async def _commit(self):
+        '''Committing a write, unless it's in a transaction() block (which commits once, at its end)'''
+        if not self.transaction_depth:
+            await self.conn.commit()
+
+    async def _execute(self, shape: tuple, query: str, params: list, cursor=None):
+        '''Executing a statement, timed when an instrumentation hook is set'''
+        cursor = cursor or self.cursor
+
+        if self.instrument is None:
+            await cursor.execute(query, params)
+            return
+
+        started = perf_counter()
+        await cursor.execute(query, params)
+        self.instrument.record(shape, query, perf_counter() - started, cursor.rowcount)
+
+    async def get(self, table: str, columns: list[str], limit: int = None, where: dict = None, or_where: dict = None, contains: dict = None,
+                  order_by: list[str] = None, desc: bool = False, after: list = None, as_tuples: bool = False):
+        '''Getting specified number of rows from a table for specified columns with optional WHERE, OR_WHERE and CONTAINS.
+            With ORDER_BY rows are sorted on those columns, and AFTER (their values from the last row of a page) fetches the next page.
+            AS_TUPLES gives plain tuples in column order instead of dicts, for hot paths that don't need the keys.
+        '''
+        cursor = await self._cursor(as_tuples, read=True)
+        await self._execute(*self._get_statement(table, columns, limit, where, or_where, contains, order_by, desc, after), cursor=cursor)
+        return await cursor.fetchall()
+
+    async def stream(self, table: str, columns: list[str], where: dict = None, or_where: dict = None, contains: dict = None,
+                     order_by: list[str] = None, desc: bool = False, fetch_size: int = None):
+        '''Like get, but reading through a server-side cursor and yielding the rows in batches of `fetch_size`,
+            so only one batch at a time is held in memory however many rows there are.
+            The cursor lives in a transaction that stays open until the generator is exhausted or closed.
+        '''
+        shape, query, params = self._get_statement(table, columns, None, where, or_where, contains, order_by, desc, None)
+        fetch_size = fetch_size or self.stream_fetch_size
+
+        started = perf_counter()
+        rows = 0
+        conn = (await self._cursor(read=True)).connection
+        cursor = conn.cursor(name=f'gb_stream_{next(self._stream_ids)}', row_factory=dict_row)
+        try:
+            await cursor.execute(query, params)
+            while True:
+                batch = await cursor.fetchmany(fetch_size)
+                if not batch:
+                    break
+                rows += len(batch)
+                yield batch
+        finally:
+            await cursor.close()
+            if self.instrument is not None:
+                self.instrument.record(shape, query, perf_counter() - started, rows)
+
+    async def get_one(self, table: str, columns: list[str], where: dict = None):
+        '''Getting a single row in a form of dict from a table for specified columns with optional WHERE'''
+        result = await self.get(table, columns, limit=1, where=where)
+        if len(result):
+            return result[0]
+
+    async def get_contains(self, table: str, columns: list[str], search: str, limit: int = None):
+        '''Getting records where a search term is present in specified columns'''
+        cursor = await self._cursor(read=True)
+        await self._execute(*self._get_contains_statement(table, columns, search, limit), cursor=cursor)
+        return await cursor.fetchall()
+
+    async def search(self, table: str, columns: list[str], search: str, vector: str, config: str = 'simple',
+                     limit: int = None, where: dict = None, or_where: dict = None, after: list = None, as_tuples: bool = False):
+        '''Full-text searching a table through its indexed tsvector column, best matches first (with a rank column).
+            Optional WHERE and OR_WHERE are matched together, i.e. ... AND ((where) OR (or_where)),
+            AFTER is the (rank, id) of the last row of a previous page, AS_TUPLES is as in get (rank comes last).
+        '''
+        cursor = await self._cursor(as_tuples, read=True)
+        await self._execute(*self._search_statement(table, columns, search, vector, config, limit, where, or_where, after), cursor=cursor)
+        return await cursor.fetchall()
+
+    async def write(self, table: str, columns: list[str], values: list):
+        '''Writing into a table an arbitrary number of values'''
+        await self._execute(*self._write_statement(table, columns, values))
+        row = await self.cursor.fetchone()
+        await self._commit()
+        self._wrote()
+        return row.get('id')
+
+    async def write_many(self, table: str, columns: list[str], rows: list):
+        '''Writing many rows of values into a table with multi-row INSERTs, committed once.
+            Returning the ids of the rows in the order they were given.
+        '''
+        ids = []
+        for statement in self._write_many_statements(table, columns, rows):
+            await self._execute(*statement)
+            ids += [row.get('id') for row in await self.cursor.fetchall()]
+        await self._commit()
+        self._wrote()
+        return ids
+
+    async def update(self, table: str, columns: list[str], values: list, where: dict = None):
+        '''Updating an arbitrary number of columns with values, with optional WHERE.
+            Returning a number of affected rows.
+        '''
+        await self._execute(*self._update_statement(table, columns, values, where))
+        await self._commit()
+        self._wrote()
+        return self.cursor.rowcount
+
+    async def call(self, function: str, args: list):
+        '''Calling a DB function and committing whatever it changed, returning its rows
+            (a scalar function gives one row, with the value under the function name)
+        '''
+        await self._execute(*self._call_statement(function, args))
+        rows = await self.cursor.fetchall()
+        await self._commit()
+        self._wrote()
+        return rows
+
+    async def delete(self, table: str, where: dict = None):
+        await self._execute(*self._delete_statement(table, where))
+        await self._commit()
+        self._wrote()
+        return self.cursor.rowcount
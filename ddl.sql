@@ -28,4 +28,166 @@ create table if not exists upvotes (
     user_id integer not null references users(id) on delete cascade,
     message_id integer not null references guestbook(id) on delete cascade,
     created_at timestamp not null default now()
-);
\ No newline at end of file
+);
+
+-- full-text search over messages: a generated tsvector kept in sync by Postgres, with a GIN index on it
+alter table guestbook add column if not exists message_tsv tsvector
+    generated always as (to_tsvector('simple', message)) stored;
+
+create index if not exists guestbook_message_tsv_idx on guestbook using gin (message_tsv);
+
+-- keyset pagination of messages on (created_at, id)
+create index if not exists guestbook_created_at_id_idx on guestbook (created_at, id);
+
+-- a materialized upvote counter per message, maintained by a trigger in the same transaction as the upvote itself
+alter table guestbook add column if not exists n_upvotes integer not null default 0;
+
+create or replace function count_upvote() returns trigger as $$
+begin
+    if tg_op = 'INSERT' then
+        update guestbook set n_upvotes = n_upvotes + 1 where id = new.message_id;
+    else
+        update guestbook set n_upvotes = n_upvotes - 1 where id = old.message_id;
+    end if;
+    return null;
+end;
+$$ language plpgsql;
+
+drop trigger if exists upvotes_count on upvotes;
+create trigger upvotes_count after insert or delete on upvotes
+    for each row execute function count_upvote();
+
+-- backfilling counters for upvotes cast before the trigger existed (touches nothing once they're in step)
+update guestbook set n_upvotes = counted.n_upvotes
+from (select message_id, count(*) as n_upvotes from upvotes group by message_id) as counted
+where guestbook.id = counted.message_id and guestbook.n_upvotes <> counted.n_upvotes;
+
+-- the leaderboard, read straight off an index instead of aggregating upvotes
+create or replace view top_messages as
+    select id, message, n_upvotes from guestbook
+    where not private and n_upvotes > 0
+    order by n_upvotes desc, id;
+
+create index if not exists guestbook_top_messages_idx on guestbook (n_upvotes desc, id) where not private;
+
+-- one upvote per user and message (dropping duplicates cast before the index existed, the trigger un-counts them)
+delete from upvotes as duplicate using upvotes as original
+where duplicate.user_id = original.user_id and duplicate.message_id = original.message_id and duplicate.id > original.id;
+
+create unique index if not exists upvotes_user_id_message_id_idx on upvotes (user_id, message_id);
+
+-- all of the upvote checks and the insert in a single statement, so concurrent upvotes can't both pass them;
+-- returns an HTTP-like status: 201 upvoted, 404 no such message, 403 own or private message, 409 already upvoted
+create or replace function upvote_message(p_user_id integer, p_message_id integer) returns integer as $$
+    with message as (
+        select id, user_id, private from guestbook where id = p_message_id
+    ), upvote as (
+        insert into upvotes (user_id, message_id)
+        select p_user_id, id from message where user_id <> p_user_id and not private
+        on conflict (user_id, message_id) do nothing
+        returning id
+    )
+    select case
+        when not exists (select 1 from message) then 404
+        when exists (select 1 from upvote) then 201
+        when (select user_id = p_user_id or private from message) then 403
+        else 409
+    end;
+$$ language sql;
+
+-- many upvotes by one user in one statement (and so one transaction), with a status per message
+create or replace function upvote_messages(p_user_id integer, p_message_ids bigint[])
+returns table (message_id integer, status integer) as $$
+    select ids.message_id::integer, upvote_message(p_user_id, ids.message_id::integer)
+    from unnest(p_message_ids) with ordinality as ids (message_id, n)
+    order by ids.n;
+$$ language sql;
+
+-- outgoing emails, committed with whatever triggered them and sent later by the outbox worker
+create table if not exists email_outbox (
+    id serial primary key,
+    email_to text not null,
+    subject text not null,
+    body text not null,
+    attempts integer not null default 0,
+    next_attempt_at timestamp not null default now(),
+    last_error text,
+    sent_at timestamp,
+    created_at timestamp not null default now()
+);
+
+create index if not exists email_outbox_pending_idx on email_outbox (next_attempt_at) where sent_at is null;
+
+-- leasing a batch of due emails to a worker: they aren't handed out again for p_lease_seconds,
+-- so several workers can drain the outbox and a crashed worker's emails are retried
+create or replace function claim_emails(p_limit integer, p_lease_seconds integer, p_max_attempts integer)
+returns setof email_outbox as $$
+    update email_outbox
+    set attempts = attempts + 1, next_attempt_at = now() + make_interval(secs => p_lease_seconds)
+    where id in (
+        select id from email_outbox
+        where sent_at is null and next_attempt_at <= now() and attempts < p_max_attempts
+        order by next_attempt_at
+        limit p_limit
+        for update skip locked
+    )
+    returning *;
+$$ language sql;
+
+create or replace function retry_email(p_id integer, p_error text, p_delay_seconds integer) returns void as $$
+    update email_outbox
+    set last_error = p_error, next_attempt_at = now() + make_interval(secs => p_delay_seconds)
+    where id = p_id;
+$$ language sql;
+
+-- activation tokens expire (after a day by default) and are marked when used, the purge_tokens job deletes both kinds
+alter table tokens add column if not exists expires_at timestamp;
+alter table tokens add column if not exists used_at timestamp;
+
+update tokens set expires_at = created_at + interval '1 day' where expires_at is null;
+update tokens set used_at = coalesce(users.activated_at, now())
+from users where users.id = tokens.user_id and users.active and tokens.used_at is null;
+
+alter table tokens alter column expires_at set default now() + interval '1 day', alter column expires_at set not null;
+
+create unique index if not exists tokens_token_idx on tokens (token);
+create index if not exists tokens_expires_at_idx on tokens (expires_at);
+create index if not exists tokens_used_at_idx on tokens (used_at) where used_at is not null;
+
+-- the token lookup, the activation and marking the token used in a single statement;
+-- returns an HTTP-like status: 200 activated, 404 no such token, 409 already activated (token used), 410 expired token
+create or replace function activate_user(p_token text)
+returns table (status integer, user_id integer) as $$
+    with token as (
+        select id, user_id, expires_at > now() as valid, used_at is not null as used from tokens where token = p_token
+    ), activated as (
+        update users set active = true, activated_at = now()
+        from token
+        where users.id = token.user_id and token.valid and not token.used and not users.active
+        returning users.id
+    ), used as (
+        update tokens set used_at = now()
+        where id = (select id from token) and exists (select 1 from activated)
+    )
+    select case
+        when exists (select 1 from activated) then 200
+        when not exists (select 1 from token) then 404
+        when (select used from token) then 409
+        when not (select valid from token) then 410
+        else 409
+    end, (select user_id from token);
+$$ language sql;
+
+-- deleting up to p_batch expired or used tokens, skipping rows locked by a concurrent activation; returns how many went
+create or replace function purge_tokens(p_batch integer) returns integer as $$
+    with purged as (
+        delete from tokens where id in (
+            select id from tokens
+            where expires_at <= now() or used_at is not null
+            limit p_batch
+            for update skip locked
+        )
+        returning 1
+    )
+    select count(*)::integer from purged;
+$$ language sql;
@@ -1,30 +1,77 @@
-from db import Database
+from auth_cache import credential_cache
+from db import Database, PoolExhausted
+from db_async import AsyncDatabase
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from utils import verify_psw
+from hashing import hasher, HasherBusy
+from psycopg_pool import PoolTimeout, TooManyRequests
 
 # creating a secutity context
 security = HTTPBasic()
 
 
+def busy_error():
+    '''A 503 for when a bounded resource (DB pool, hashing pool) has no room left'''
+    return HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                         detail='The service is busy right now, please try again shortly.', headers={'Retry-After': '1'})
+
+
 def get_db():
     '''A special function for dependency injection pattern'''
     db = Database()
 
     try:
         db.open()
+    except PoolExhausted:
+        raise busy_error()
+
+    try:
         yield db
     finally:
         db.close()
 
 
-def validate_user(credentials: HTTPBasicCredentials = Depends(security), db: Database = Depends(get_db)):
+async def get_async_db():
+    '''An async counterpart of get_db, borrowing from the async pool'''
+    db = AsyncDatabase()
+
+    try:
+        await db.open()
+    except (PoolTimeout, TooManyRequests):
+        raise busy_error()
+
+    try:
+        yield db
+    finally:
+        await db.close()
+
+
+async def validate_user(credentials: HTTPBasicCredentials = Depends(security), db: AsyncDatabase = Depends(get_async_db)):
     '''A helper to validate user credentials against what we have stored in our DB'''
-    user = db.get_one('users', ['id', 'password', 'active'], where={
-                      'email': credentials.username})
+    user_id = credential_cache.get(credentials.username, credentials.password)
+    if user_id is not None:
+        db.sticky_key = user_id
+        return user_id
+
+    user = await db.get_one('users', ['id', 'password', 'active'], where={
+                            'email': credentials.username})
+
+    if (not user or not user.get('active')) and db.replicas is not None and not db.primary_reads:
+        # the replica read from may not have caught up with a just registered or activated account yet
+        db.primary_reads = True
+        user = await db.get_one('users', ['id', 'password', 'active'], where={
+                                'email': credentials.username})
 
     if user and user.get('active'):
-        if verify_psw(credentials.password, user.get('password')):
+        try:
+            verified = await hasher.verify(credentials.password, user.get('password'))
+        except HasherBusy:
+            raise busy_error()
+
+        if verified:
+            credential_cache.add(credentials.username,
+                                 credentials.password, user.get('id'))
+            db.sticky_key = user.get('id')
             return user.get('id')
 
     raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
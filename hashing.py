@@ -0,0 +1,114 @@
+from asyncio import get_running_loop, gather
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from os import environ as env, cpu_count
+from time import time
+from utils import get_psw_hash, verify_psw
+
+# a cheap (4 rounds) hash to verify, just to get the bcrypt backend loaded
+WARMUP_HASH = '$2b$04$8l0RX2f5NpgiKHd19zgBseeLolKKngERQ8KOJGUHwsyoKiXib6Y5O'
+
+
+class HasherBusy(Exception):
+    '''Raised when too many password hashing jobs are already waiting for a worker, or the workers keep dying'''
+
+
+def _timed(func, *args):
+    '''Runs inside a worker process, reporting when the job actually started and how long it took'''
+    started = time()
+    result = func(*args)
+    return result, started, time() - started
+
+
+class PasswordHasher:
+    '''Runs bcrypt hashing and verification on a dedicated process pool, so it scales across cores
+        without holding up the request-serving event loop and threads.
+    '''
+
+    def __init__(self, workers: int = None, max_queue: int = 64):
+        self.workers = workers
+        self.max_queue = max_queue
+
+        self._executor = None
+        self._pending = 0
+        self.stats = {'jobs': 0, 'rejected': 0, 'restarts': 0, 'queue_wait_total': 0.0, 'queue_wait_max': 0.0,
+                      'hash_time_total': 0.0, 'hash_time_max': 0.0}
+
+    def _get_executor(self):
+        # created on first use, so a forked server worker gets its own pool;
+        # 'spawn' since forking a process that already runs threads isn't safe
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=get_context('spawn'))
+        return self._executor
+
+    async def _submit(self, func, *args):
+        executor = self._get_executor()
+        try:
+            return await get_running_loop().run_in_executor(executor, _timed, func, *args)
+        except BrokenProcessPool:
+            # a worker process died (e.g. killed for memory) and the pool takes no more jobs: the next one gets a new pool;
+            # the jobs in flight all fail with it, only the first to get here replaces it
+            if self._executor is executor:
+                self._executor = None
+                self.stats['restarts'] += 1
+                executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    async def _run(self, func, *args):
+        if self._pending >= self.max_queue:
+            self.stats['rejected'] += 1
+            raise HasherBusy(f'{self._pending} password hashing jobs are already queued')
+
+        self._pending += 1
+        submitted = time()
+        try:
+            try:
+                result, started, took = await self._submit(func, *args)
+            except BrokenProcessPool:
+                # retried once on a new pool, a job that breaks that one too isn't tried again
+                try:
+                    result, started, took = await self._submit(func, *args)
+                except BrokenProcessPool:
+                    raise HasherBusy('The password hashing processes failed')
+        finally:
+            self._pending -= 1
+
+        waited = max(started - submitted, 0.0)
+        self.stats['jobs'] += 1
+        self.stats['queue_wait_total'] += waited
+        self.stats['queue_wait_max'] = max(self.stats['queue_wait_max'], waited)
+        self.stats['hash_time_total'] += took
+        self.stats['hash_time_max'] = max(self.stats['hash_time_max'], took)
+
+        return result
+
+    async def hash(self, password: str):
+        return await self._run(get_psw_hash, password)
+
+    async def verify(self, plain_psw: str, hashed_psw: str):
+        return await self._run(verify_psw, plain_psw, hashed_psw)
+
+    async def warmup(self):
+        '''Starting every worker process and loading bcrypt in each, so the first logins don't pay for it'''
+        loop = get_running_loop()
+        # submitted all at once, none of them finds an idle worker and each spawns one
+        await gather(*(loop.run_in_executor(self._get_executor(), verify_psw, 'warmup', WARMUP_HASH)
+                       for _ in range(self.workers or cpu_count() or 1)))
+
+    def metrics(self):
+        '''Queue wait vs. hash time, cumulative and averaged over finished jobs'''
+        jobs = self.stats['jobs'] or 1
+        return {**self.stats, 'pending': self._pending,
+                'queue_wait_avg': self.stats['queue_wait_total'] / jobs,
+                'hash_time_avg': self.stats['hash_time_total'] / jobs}
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+hasher = PasswordHasher(workers=int(env.get('HASHER_WORKERS', 0)) or None,
+                        max_queue=int(env.get('HASHER_MAX_QUEUE', 64)))
@@ -0,0 +1,114 @@
+from argparse import ArgumentParser
+import json
+from os import environ as env
+import re
+from urllib.request import urlopen
+from psycopg2 import connect
+from dotenv import load_dotenv
+
+# before db reads its settings (replicas, prepared statements) on import
+load_dotenv()
+
+from db import Database
+
+PLACEHOLDER = re.compile(r'\$(\d+)')
+
+
+def load_shapes(source: str):
+    '''(query, calls) of the query shapes the app recorded, from its /metrics endpoint or a saved copy of it'''
+    if source.startswith(('http://', 'https://')):
+        with urlopen(source) as response:
+            metrics = json.load(response)
+    else:
+        with open(source) as file:
+            metrics = json.load(file)
+
+    return [(shape['query'], shape['calls']) for shape in metrics['db']['queries']]
+
+
+def seq_scans(plan: dict):
+    '''Every Seq Scan node of a JSON plan tree'''
+    if plan['Node Type'] == 'Seq Scan':
+        yield plan
+    for child in plan.get('Plans', []):
+        yield from seq_scans(child)
+
+
+def explain(cursor, query: str):
+    '''The generic plan of a statement, the one a prepared statement ends up with, whatever its parameters'''
+    numbered = Database._numbered(query)
+    params = max(map(int, PLACEHOLDER.findall(numbered)), default=0)
+
+    cursor.execute(f'prepare gb_advisor as {numbered}')
+    cursor.execute('set local plan_cache_mode to force_generic_plan')
+    cursor.execute(f"explain (format json) execute gb_advisor ({','.join(['null'] * params)})" if params
+                   else 'explain (format json) execute gb_advisor')
+    return cursor.fetchone()[0][0]['Plan']
+
+
+def advise(url: str, shapes: list):
+    '''The sequential scans in the plans of the query shapes against the current schema, the most expensive first.
+
+        Each statement is only planned, inside a read only transaction that is rolled back; its cost is weighted by
+        how many times it was called. Tiny tables are scanned sequentially whatever their indexes, so the figures
+        mean most against a DB the size of production (e.g. one seeded with `python -m benchmarks seed`).
+        Calls of the SQL functions in ddl.sql (language sql, volatile, so never inlined) plan as a Function Scan,
+        the statements inside them aren't seen.
+    '''
+    conn = connect(url)
+    # transactions begun explicitly, psycopg2's own BEGIN would come first and make a later BEGIN READ ONLY a no-op
+    conn.autocommit = True
+    findings, errors = [], []
+
+    try:
+        with conn.cursor() as cursor:
+            for query, calls in shapes:
+                try:
+                    cursor.execute('begin read only')
+                    plan = explain(cursor, query)
+                except Exception as e:
+                    errors.append({'query': query, 'error': str(e).splitlines()[0]})
+                    continue
+                finally:
+                    cursor.execute('rollback')
+                    # a prepared statement isn't undone by the rollback, one left behind would fail the next PREPARE
+                    cursor.execute('deallocate all')
+
+                for node in seq_scans(plan):
+                    findings.append({'relation': node['Relation Name'], 'filter': node.get('Filter'),
+                                     'rows': node['Plan Rows'], 'cost': node['Total Cost'],
+                                     'plan_cost': plan['Total Cost'], 'calls': calls,
+                                     'weighted_cost': round(node['Total Cost'] * max(calls, 1), 2), 'query': query})
+    finally:
+        conn.close()
+
+    return sorted(findings, key=lambda finding: finding['weighted_cost'], reverse=True), errors
+
+
+def main():
+    parser = ArgumentParser(prog='python index_advisor.py',
+                            description='Report the sequential scans in the plans of the query shapes the app runs')
+    parser.add_argument('source', nargs='?', default='http://127.0.0.1:8000/metrics',
+                        help="a running app's /metrics URL (with DB_METRICS on) or a JSON file saved from it")
+    parser.add_argument('--url', default=env.get('CONNECTION_URL'), help='the DB to plan against (CONNECTION_URL)')
+    parser.add_argument('--json', action='store_true', help='print the findings as JSON')
+    args = parser.parse_args()
+
+    findings, errors = advise(args.url, load_shapes(args.source))
+
+    if args.json:
+        print(json.dumps({'seq_scans': findings, 'errors': errors}, indent=2))
+        return
+
+    for finding in findings:
+        print(f"{finding['relation']:<16} cost {finding['cost']:>10} x {finding['calls']:<6} rows {finding['rows']:<8} "
+              f"filter {finding['filter'] or '-'}")
+        print(f"    {finding['query']}")
+    for error in errors:
+        print(f"could not plan: {error['query']}\n    {error['error']}")
+    if not findings:
+        print('no sequential scans')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+from bisect import bisect_left
+from collections import deque
+from contextvars import ContextVar
+from os import environ as env
+from random import random
+from threading import Lock
+from time import time
+import logging
+
+# upper bounds (in seconds) of the query latency histogram buckets, the last bucket takes everything slower
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# upper bounds of the queries-per-request histogram buckets
+REQUEST_QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+
+slow_query_log = logging.getLogger('guestbook.slow_queries')
+
+# a mutable [count] of the queries run while serving the current HTTP request, None outside of one
+_request_queries = ContextVar('request_queries', default=None)
+
+
+class QueryMetrics:
+    '''A Database instrumentation hook: per query shape latency histograms and row counts,
+        queries per HTTP request, and a sampled log of slow queries.
+
+        Only parameterized query templates are kept and logged, never the values bound to them.
+    '''
+
+    def __init__(self, slow_threshold: float = 0.25, slow_sample: float = 1.0, slow_log_size: int = 50):
+        self.slow_threshold = slow_threshold
+        self.slow_sample = slow_sample
+
+        self._shapes = {}  # shape -> {'query', 'calls', 'rows', 'time_total', 'time_max', 'buckets'}
+        self._slow = deque(maxlen=slow_log_size)
+        self._requests = {'requests': 0, 'queries_total': 0, 'queries_max': 0,
+                          'buckets': [0] * (len(REQUEST_QUERY_BUCKETS) + 1)}
+        self._lock = Lock()
+
+    def record(self, shape: tuple, query: str, elapsed: float, rows: int):
+        '''Called by Database after each statement, with the time it took and the number of rows it returned or affected'''
+        counter = _request_queries.get()
+        if counter is not None:
+            counter[0] += 1
+
+        with self._lock:
+            stats = self._shapes.get(shape)
+            if stats is None:
+                stats = self._shapes[shape] = {'query': ' '.join(query.split()), 'calls': 0, 'rows': 0,
+                                               'time_total': 0.0, 'time_max': 0.0,
+                                               'buckets': [0] * (len(LATENCY_BUCKETS) + 1)}
+            stats['calls'] += 1
+            stats['rows'] += max(rows, 0)
+            stats['time_total'] += elapsed
+            stats['time_max'] = max(stats['time_max'], elapsed)
+            stats['buckets'][bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+
+        if elapsed >= self.slow_threshold and random() < self.slow_sample:
+            entry = {'query': stats['query'], 'elapsed_ms': round(elapsed * 1000, 3), 'rows': rows, 'at': time()}
+            self._slow.append(entry)
+            slow_query_log.warning('Slow query (%.1f ms, %d rows): %s', elapsed * 1000, rows, entry['query'])
+
+    def request_started(self):
+        '''Starting to count the queries of the current request, returns a token for request_finished'''
+        return _request_queries.set([0])
+
+    def request_finished(self, token):
+        queries = _request_queries.get()[0]
+        _request_queries.reset(token)
+
+        with self._lock:
+            self._requests['requests'] += 1
+            self._requests['queries_total'] += queries
+            self._requests['queries_max'] = max(self._requests['queries_max'], queries)
+            self._requests['buckets'][bisect_left(REQUEST_QUERY_BUCKETS, queries)] += 1
+
+    def metrics(self):
+        '''A snapshot of everything recorded so far, the most time consuming query shapes first'''
+        with self._lock:
+            shapes = [{**stats, 'buckets': list(stats['buckets']),
+                       'time_avg': stats['time_total'] / stats['calls']} for stats in self._shapes.values()]
+            requests = {**self._requests, 'buckets': list(self._requests['buckets'])}
+
+        requests['queries_avg'] = requests['queries_total'] / (requests['requests'] or 1)
+        return {'latency_buckets': LATENCY_BUCKETS,
+                'queries': sorted(shapes, key=lambda stats: stats['time_total'], reverse=True),
+                'request_query_buckets': REQUEST_QUERY_BUCKETS,
+                'requests': requests,
+                'slow_queries': list(self._slow)}
+
+    def reset(self):
+        with self._lock:
+            self._shapes.clear()
+            self._slow.clear()
+            self._requests.update(requests=0, queries_total=0, queries_max=0,
+                                  buckets=[0] * (len(REQUEST_QUERY_BUCKETS) + 1))
+
+
+class QueryCountMiddleware:
+    '''ASGI middleware letting a QueryMetrics hook count the queries of each HTTP request'''
+
+    def __init__(self, app, metrics: QueryMetrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        token = self.metrics.request_started()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.metrics.request_finished(token)
+
+
+query_metrics = QueryMetrics(slow_threshold=float(env.get('DB_SLOW_QUERY_MS', 250)) / 1000,
+                             slow_sample=float(env.get('DB_SLOW_QUERY_SAMPLE', 1.0)),
+                             slow_log_size=int(env.get('DB_SLOW_QUERY_LOG_SIZE', 50)))
@@ -0,0 +1,61 @@
+from asyncio import Lock
+from os import environ as env
+from time import monotonic
+
+
+class Leaderboard:
+    '''The top-N most upvoted public messages, kept in memory.
+
+        It's re-read from the top_messages view at most every `ttl` seconds, and in between
+        upvotes on messages already on the board are counted in place.
+    '''
+
+    def __init__(self, size: int = 10, ttl: float = 5):
+        self.size = size
+        self.ttl = ttl
+
+        self._messages = []
+        self._loaded_at = None
+        self._lock = Lock()
+        # bumped by every invalidation, so a refresh that read the view before one isn't taken as fresh
+        self._generation = 0
+
+    def _stale(self):
+        return self._loaded_at is None or monotonic() - self._loaded_at >= self.ttl
+
+    async def get(self, db):
+        if self._stale():
+            # one request refreshes the board, the ones arriving meanwhile wait for it instead of hitting the DB too
+            async with self._lock:
+                if self._stale():
+                    generation = self._generation
+                    self._messages = await db.get('top_messages', ['id', 'message', 'n_upvotes'], limit=self.size)
+                    if generation == self._generation:
+                        self._loaded_at = monotonic()
+
+        return self._messages
+
+    def upvoted(self, message_id: int):
+        '''Counting an upvote on a message that's on the board, others may make it there on the next refresh'''
+        for message in self._messages:
+            if message['id'] == message_id:
+                message['n_upvotes'] += 1
+                self._messages.sort(key=lambda m: (-m['n_upvotes'], m['id']))
+                break
+
+    def discard(self, message_id: int):
+        '''Dropping a message that was deleted, made private or edited, re-reading the board if it was on it'''
+        if any(message['id'] == message_id for message in self._messages):
+            self._messages = [message for message in self._messages if message['id'] != message_id]
+            self.invalidate()
+
+    def invalidate(self):
+        self._generation += 1
+        self._loaded_at = None
+
+    def metrics(self):
+        return {'size': len(self._messages)}
+
+
+leaderboard = Leaderboard(size=int(env.get('LEADERBOARD_SIZE', 10)),
+                          ttl=float(env.get('LEADERBOARD_TTL', 5)))
@@ -1,6 +1,28 @@
+from dotenv import load_dotenv
+
+# `uvicorn main:app` reads no .env of its own; loaded before the modules below read their settings on import
+# (it doesn't override variables already set, e.g. by serve.py or --env-file)
+load_dotenv()
+
 from fastapi import FastAPI, Form
+from admission import admission_control, AdmissionMiddleware
+import db
+import db_async
+from auth_cache import credential_cache
+from db_async import get_async_pool, close_async_pools
+from hashing import hasher
+from instrumentation import query_metrics, QueryCountMiddleware
+from leaderboard import leaderboard
+import logging
+import maintenance
+from os import environ as env
+import outbox
+from psycopg_pool import PoolTimeout
+from response_cache import response_cache
 from routers import accounts, messages, test
+import write_behind
 
+log = logging.getLogger('guestbook')
 
 app = FastAPI(
     title='Guestbook API',
@@ -13,6 +35,72 @@ app.include_router(accounts.router)
 app.include_router(messages.router)
 app.include_router(test.router)
 
+# timing every statement costs a couple of clock reads per query, DB_METRICS=0 turns it off altogether
+if env.get('DB_METRICS', '1') == '1':
+    db.Database.instrument = query_metrics
+    app.add_middleware(QueryCountMiddleware, metrics=query_metrics)
+
+# added last, so it's the outermost middleware and turns requests away before anything else runs
+if env.get('ADMISSION_CONTROL', '1') == '1':
+    app.add_middleware(AdmissionMiddleware, control=admission_control)
+
+
+async def warmup(pool):
+    '''Doing what the first requests would otherwise wait for; uvicorn only starts accepting connections after this'''
+    try:
+        await pool.wait(timeout=float(env.get('WARMUP_TIMEOUT', 10)))
+    except PoolTimeout:
+        log.warning('The DB pool could not be filled during warmup, serving anyway')
+
+    await hasher.warmup()
+    # generated on the first /docs visit otherwise
+    app.openapi()
+
+
+@app.on_event('startup')
+async def open_db_pool():
+    # filling the pool before the first request comes in
+    pool = await get_async_pool()
+    if env.get('WARMUP', '1') == '1':
+        await warmup(pool)
+    if env.get('OUTBOX_WORKER', '1') == '1':
+        outbox.start_worker()
+    if env.get('MAINTENANCE_WORKER', '1') == '1':
+        maintenance.start_worker()
+    if env.get('WRITE_BEHIND', '0') == '1':
+        write_behind.start()
+
+
+@app.on_event('shutdown')
+async def close_db_pool():
+    # the buffered writes still need the pool
+    await write_behind.stop()
+    await close_async_pools()
+    hasher.shutdown()
+    outbox.stop_worker()
+    maintenance.stop_worker()
+    # after the workers, the last borrowers of the sync pools
+    db.close_pools()
+
+
+@app.get('/metrics', include_in_schema=False)
+def get_metrics():
+    # this worker process's view, every worker keeps its own counters
+    return {
+        'db': query_metrics.metrics() if db.Database.instrument is query_metrics else None,
+        'pools': {'sync': db.pool_metrics(), 'async': db_async.pool_metrics()},
+        'templates': {'sync': db.Database.template_metrics(), 'async': db_async.AsyncDatabase.template_metrics()},
+        'hasher': hasher.metrics(),
+        'admission': admission_control.metrics(),
+        'outbox': outbox.metrics(),
+        'maintenance': maintenance.metrics(),
+        'write_behind': write_behind.metrics(),
+        'response_cache': response_cache.metrics(),
+        'credential_cache': credential_cache.metrics(),
+        'leaderboard': leaderboard.metrics(),
+        'replicas': db.Database.replicas.metrics() if db.Database.replicas is not None else None
+    }
+
 
 # HTTP GET requests
 
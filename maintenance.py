@@ -0,0 +1,63 @@
+from os import environ as env
+import logging
+from dotenv import load_dotenv
+
+if __name__ == '__main__':
+    # running as a process of its own, .env has to be loaded before db reads its settings on import
+    load_dotenv()
+
+from db import Database
+from workers import PeriodicWorker, WorkerSlot, run_standalone
+
+log = logging.getLogger('guestbook.maintenance')
+
+
+class MaintenanceWorker(PeriodicWorker):
+    '''Periodically purges expired and used activation tokens, in bounded batches with a pause in between,
+        so each delete holds its row locks only briefly and the tokens table stays small
+    '''
+
+    def __init__(self, interval: float = 600, batch_size: int = 1000, pause: float = 0.1):
+        super().__init__('maintenance-worker', interval, log)
+        self.batch_size = batch_size
+        self.pause = pause
+
+        self.stats = {'runs': 0, 'tokens_purged': 0}
+
+    def purge_tokens(self, db: Database):
+        '''Deleting batches of purgeable tokens until a batch comes up short, returning how many were deleted'''
+        purged = 0
+
+        while not self._stopping.is_set():
+            deleted = db.call('purge_tokens', [self.batch_size])[0]['purge_tokens']
+            purged += deleted
+            if deleted < self.batch_size:
+                break
+            self._stopping.wait(self.pause)
+
+        self.stats['tokens_purged'] += purged
+        return purged
+
+    def work(self, db: Database):
+        self.purge_tokens(db)
+        self.stats['runs'] += 1
+
+    def metrics(self):
+        return dict(self.stats)
+
+
+def create_worker():
+    return MaintenanceWorker(interval=float(env.get('TOKEN_PURGE_INTERVAL', 600)),
+                             batch_size=int(env.get('TOKEN_PURGE_BATCH', 1000)),
+                             pause=float(env.get('TOKEN_PURGE_PAUSE', 0.1)))
+
+
+_slot = WorkerSlot(create_worker)
+start_worker = _slot.start
+stop_worker = _slot.stop
+metrics = _slot.metrics
+
+
+if __name__ == '__main__':
+    # running the maintenance jobs as a process of their own, e.g. with MAINTENANCE_WORKER=0 for the API
+    run_standalone(create_worker)
@@ -0,0 +1,169 @@
+from hashlib import sha256
+from os import environ as env
+from pathlib import Path
+import re
+import sys
+from psycopg2 import connect
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ROOT = Path(__file__).resolve().parent
+MIGRATIONS = ROOT / 'migrations'
+
+# ddl.sql is the baseline: idempotent, applied once (also to a DB it was already applied to by hand), recorded as version 0000
+BASELINE = ('0000_ddl', ROOT / 'ddl.sql')
+
+# a migration starting with this line runs outside of a transaction, statement by statement (e.g. for CREATE INDEX CONCURRENTLY);
+# its statements are split on semicolons at line ends, so it can't hold function bodies
+NO_TRANSACTION = '-- migrate: no-transaction'
+
+# serializing concurrent runs (e.g. several instances deploying at once)
+LOCK_ID = 7213000019
+
+CONCURRENT_INDEX = re.compile(r'create\s+(?:unique\s+)?index\s+concurrently\s+if\s+not\s+exists\s+(\w+)', re.IGNORECASE)
+
+
+def migrations():
+    '''(version, path) of the baseline and of every migrations/NNNN_name.sql, in the order they apply'''
+    return [BASELINE] + [(path.stem, path) for path in sorted(MIGRATIONS.glob('[0-9][0-9][0-9][0-9]_*.sql'))]
+
+
+def _checksum(text: str):
+    return sha256(text.encode('utf8')).hexdigest()
+
+
+def _statements(text: str):
+    '''Splitting a no-transaction migration into its statements'''
+    statements, current = [], []
+    for line in text.splitlines():
+        current.append(line)
+        if line.rstrip().endswith(';'):
+            statement = '\n'.join(current).strip()
+            if any(not part.strip().startswith('--') for part in statement.splitlines() if part.strip()):
+                statements.append(statement)
+            current = []
+    return statements
+
+
+class Migrator:
+    '''Applies pending schema migrations in version order, recording each in schema_migrations with a checksum'''
+
+    def __init__(self, url: str = None):
+        self.conn = connect(url or env.get('CONNECTION_URL'))
+        self.conn.autocommit = True
+        self.cursor = self.conn.cursor()
+
+    def close(self):
+        self.cursor.close()
+        self.conn.close()
+
+    def _ensure_table(self):
+        self.cursor.execute('''
+            create table if not exists schema_migrations (
+                version text primary key,
+                checksum text not null,
+                applied_at timestamp not null default now()
+            )
+        ''')
+
+    def applied(self):
+        self._ensure_table()
+        self.cursor.execute('select version, checksum from schema_migrations')
+        return dict(self.cursor.fetchall())
+
+    def status(self):
+        '''(version, 'applied' / 'pending' / 'changed since applied') of every migration'''
+        applied = self.applied()
+        result = []
+        for version, path in migrations():
+            if version not in applied:
+                state = 'pending'
+            elif applied[version] != _checksum(path.read_text()):
+                state = 'changed since applied'
+            else:
+                state = 'applied'
+            result.append((version, state))
+        return result
+
+    def _drop_invalid_index(self, statement: str):
+        '''A CREATE INDEX CONCURRENTLY that failed halfway leaves an invalid index, which IF NOT EXISTS would keep'''
+        match = CONCURRENT_INDEX.search(statement)
+        if not match:
+            return
+
+        self.cursor.execute('''
+            select 1 from pg_index i join pg_class c on c.oid = i.indexrelid
+            where c.relname = %s and c.relnamespace = 'public'::regnamespace and not i.indisvalid
+        ''', [match.group(1)])
+        if self.cursor.fetchone():
+            print(f'  dropping the invalid index {match.group(1)} left by an earlier attempt')
+            self.cursor.execute(f'drop index concurrently if exists "{match.group(1)}"')
+
+    def apply(self, version: str, path: Path):
+        text = path.read_text()
+
+        if text.lstrip().startswith(NO_TRANSACTION):
+            for statement in _statements(text):
+                self._drop_invalid_index(statement)
+                self.cursor.execute(statement)
+            self.cursor.execute('insert into schema_migrations (version, checksum) values (%s, %s)', [version, _checksum(text)])
+            return
+
+        # the migration and its record are committed together, or neither is
+        self.conn.autocommit = False
+        try:
+            with self.conn, self.conn.cursor() as cursor:
+                cursor.execute(text)
+                cursor.execute('insert into schema_migrations (version, checksum) values (%s, %s)', [version, _checksum(text)])
+        finally:
+            self.conn.autocommit = True
+
+    def migrate(self, target: str = None):
+        '''Applying pending migrations up to and including `target` (all of them by default), returning the versions applied'''
+        available = migrations()
+        if target is not None and target not in [version for version, _ in available]:
+            raise ValueError(f'There is no migration {target}')
+
+        self.cursor.execute('select pg_advisory_lock(%s)', [LOCK_ID])
+        try:
+            applied = self.applied()
+            done = []
+
+            for version, path in available:
+                if version in applied:
+                    if applied[version] != _checksum(path.read_text()):
+                        print(f'warning: {path.name} changed since it was applied, changes belong in a new migration')
+                else:
+                    print(f'applying {path.name}')
+                    self.apply(version, path)
+                    done.append(version)
+
+                # reached whether or not it was applied already, nothing after it is
+                if version == target:
+                    break
+
+            return done
+        finally:
+            self.cursor.execute('select pg_advisory_unlock(%s)', [LOCK_ID])
+
+
+if __name__ == '__main__':
+    # python migrate.py [status | up [version]]
+    command = sys.argv[1] if len(sys.argv) > 1 else 'up'
+    migrator = Migrator()
+
+    try:
+        if command == 'status':
+            for version, state in migrator.status():
+                print(f'{version:<40} {state}')
+        elif command == 'up':
+            try:
+                applied = migrator.migrate(sys.argv[2] if len(sys.argv) > 2 else None)
+            except ValueError as e:
+                sys.exit(str(e))
+            print(f'{len(applied)} migration(s) applied')
+        else:
+            sys.exit('usage: python migrate.py [status | up [version]]')
+    finally:
+        migrator.close()
@@ -0,0 +1,12 @@
+-- migrate: no-transaction
+-- indexes for the lookups that were left to sequential scans, built without blocking writes;
+-- users.email is already served by its unique constraint's index
+
+-- a user's own messages (update/delete by id and user_id, private messages of the caller), and deleting a user's messages
+create index concurrently if not exists guestbook_user_id_private_idx on guestbook (user_id, private);
+
+-- upvotes of a message, and deleting them along with it (upvotes_user_id_message_id_idx leads with user_id)
+create index concurrently if not exists upvotes_message_id_user_id_idx on upvotes (message_id, user_id);
+
+-- deleting a user's tokens along with the user
+create index concurrently if not exists tokens_user_id_idx on tokens (user_id);
@@ -0,0 +1,8 @@
+-- upvotes by many users in one statement (and so one transaction), with a status per (user, message) pair;
+-- what the write-behind buffer flushes accepted upvotes with
+create or replace function upvote_pairs(p_user_ids bigint[], p_message_ids bigint[])
+returns table (user_id integer, message_id integer, status integer) as $$
+    select pairs.user_id::integer, pairs.message_id::integer, upvote_message(pairs.user_id::integer, pairs.message_id::integer)
+    from unnest(p_user_ids, p_message_ids) with ordinality as pairs (user_id, message_id, n)
+    order by pairs.n;
+$$ language sql;
@@ -0,0 +1,149 @@
+from email.message import EmailMessage
+from os import environ as env
+from time import monotonic
+import logging
+import smtplib
+from dotenv import load_dotenv
+
+if __name__ == '__main__':
+    # running as a process of its own, .env has to be loaded before db reads its settings on import
+    load_dotenv()
+
+from db import Database
+from workers import PeriodicWorker, WorkerSlot, run_standalone
+
+log = logging.getLogger('guestbook.outbox')
+
+
+class SMTPSession:
+    '''A long-lived, authenticated SMTP connection, (re)opened on demand'''
+
+    def __init__(self, host: str, port: int, use_ssl: bool = True, user: str = None, password: str = None, timeout: float = 30):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+
+        self._connection = None
+
+    def _connect(self):
+        smtp = smtplib.SMTP_SSL if self.use_ssl else smtplib.SMTP
+        connection = smtp(self.host, port=self.port, timeout=self.timeout)
+        if self.user:
+            connection.login(self.user, self.password)
+        return connection
+
+    def send(self, message: EmailMessage):
+        if self._connection is None:
+            self._connection = self._connect()
+
+        try:
+            self._connection.send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            # the server dropped an idle session, one fresh connection is worth a retry
+            self._connection = self._connect()
+            self._connection.send_message(message)
+
+    def close(self):
+        if self._connection is not None:
+            try:
+                self._connection.quit()
+            except smtplib.SMTPException:
+                pass
+            self._connection = None
+
+
+class OutboxWorker(PeriodicWorker):
+    '''Drains the email_outbox table in batches over one SMTP session, retrying failed emails with exponential backoff'''
+
+    def __init__(self, session: SMTPSession, sender: str, batch_size: int = 50, poll_interval: float = 5,
+                 lease: int = 300, max_attempts: int = 8, backoff: int = 30, max_backoff: int = 3600):
+        super().__init__('outbox-worker', poll_interval, log)
+        self.session = session
+        self.sender = sender
+        self.batch_size = batch_size
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.stats = {'sent': 0, 'failed': 0, 'batches': 0, 'send_time_total': 0.0}
+
+    def _message(self, email: dict):
+        message = EmailMessage()
+        message['From'] = self.sender
+        message['To'] = email['email_to']
+        message['Subject'] = email['subject']
+        message.set_content(email['body'])
+        return message
+
+    def drain(self, db: Database):
+        '''Sending one batch of due emails, returning how many there were'''
+        emails = db.call('claim_emails', [self.batch_size, self.lease, self.max_attempts])
+
+        for email in emails:
+            started = monotonic()
+            try:
+                self.session.send(self._message(email))
+            except (smtplib.SMTPException, OSError) as e:
+                self.session.close()
+                self.stats['failed'] += 1
+                delay = min(self.backoff * 2 ** (email['attempts'] - 1), self.max_backoff)
+                db.call('retry_email', [email['id'], str(e), delay])
+                continue
+
+            self.stats['send_time_total'] += monotonic() - started
+            self.stats['sent'] += 1
+            db.update('email_outbox', ['sent_at'], ['now()'], where={'id': email['id']})
+
+        if emails:
+            self.stats['batches'] += 1
+
+        return len(emails)
+
+    def work(self, db: Database):
+        # a full batch means there's probably more waiting
+        while self.drain(db) == self.batch_size and not self._stopping.is_set():
+            pass
+
+    def finish(self):
+        self.session.close()
+
+    def metrics(self):
+        uptime = monotonic() - self._started_at if self._started_at else 0
+        return {**self.stats,
+                'sent_per_second': self.stats['sent'] / uptime if uptime else 0.0,
+                'send_time_avg': self.stats['send_time_total'] / (self.stats['sent'] or 1)}
+
+
+def create_worker():
+    '''An outbox worker configured from the environment (SMTP_* settings, falling back to the UKRNET_* ones)'''
+    user = env.get('SMTP_USER', env.get('UKRNET_ADDR'))
+    session = SMTPSession(host=env.get('SMTP_HOST', 'smtp.ukr.net'),
+                          port=int(env.get('SMTP_PORT', 465)),
+                          use_ssl=env.get('SMTP_SSL', '1') == '1',
+                          user=user,
+                          password=env.get('SMTP_PASSWORD', env.get('UKRNET_APP_PWD')))
+
+    return OutboxWorker(session, sender=env.get('SMTP_FROM', user) or 'guestbook@localhost',
+                        batch_size=int(env.get('OUTBOX_BATCH_SIZE', 50)),
+                        poll_interval=float(env.get('OUTBOX_POLL_INTERVAL', 5)),
+                        max_attempts=int(env.get('OUTBOX_MAX_ATTEMPTS', 8)))
+
+
+_slot = WorkerSlot(create_worker)
+start_worker = _slot.start
+stop_worker = _slot.stop
+metrics = _slot.metrics
+
+
+def notify():
+    '''Waking this process's outbox worker (if it runs one) after an email was committed'''
+    _slot.notify()
+
+
+if __name__ == '__main__':
+    # running the outbox worker as a process of its own, e.g. with OUTBOX_WORKER=0 for the API
+    run_standalone(create_worker)
@@ -0,0 +1,99 @@
+from itertools import count
+from os import environ as env
+from threading import Lock
+from time import monotonic
+
+# seconds the replica is behind the primary: 0 once it has replayed everything it received
+# (an idle primary would otherwise look like a growing lag), NULL-safe on a server that isn't a standby
+LAG_QUERY = '''
+    select case
+        when pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() then 0
+        else coalesce(extract(epoch from now() - pg_last_xact_replay_timestamp()), 0)
+    end as lag
+'''
+
+
+class ReplicaSet:
+    '''Read replicas of the primary DB, handed out round robin among those keeping up with it.
+
+        A replica's lag is re-measured (on the connection just borrowed from it) at most every `check_interval`
+        seconds; a replica more than `max_lag` seconds behind, or one that couldn't be reached in the last
+        `retry_after` seconds, is skipped and reads fall back to the primary.
+        Keys pinned after a write (e.g. a user id) read from the primary for `sticky_for` seconds, so users see their own writes.
+    '''
+
+    def __init__(self, urls: list[str], max_lag: float = 5, check_interval: float = 1, retry_after: float = 30,
+                 sticky_for: float = 5, timeout: float = 1):
+        self.urls = urls
+        self.timeout = timeout  # how long to wait for a replica connection before reading from the primary instead
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.retry_after = retry_after
+        self.sticky_for = sticky_for
+
+        self._state = {url: {'lag': 0.0, 'checked_at': None, 'down_until': 0.0} for url in urls}
+        self._next = count()
+        self._pinned = {}  # key -> pinned until
+        self._lock = Lock()
+        self.stats = {'replica_reads': 0, 'primary_reads': 0, 'lagging': 0, 'failures': 0}
+
+    @classmethod
+    def from_env(cls):
+        '''A ReplicaSet for the comma separated REPLICA_URLS, None if there are none'''
+        urls = [url.strip() for url in env.get('REPLICA_URLS', '').split(',') if url.strip()]
+        if not urls:
+            return None
+
+        return cls(urls, max_lag=float(env.get('REPLICA_MAX_LAG', 5)),
+                   check_interval=float(env.get('REPLICA_CHECK_INTERVAL', 1)),
+                   retry_after=float(env.get('REPLICA_RETRY_AFTER', 30)),
+                   sticky_for=float(env.get('REPLICA_STICKY_FOR', 5)),
+                   timeout=float(env.get('REPLICA_TIMEOUT', 1)))
+
+    def candidates(self):
+        '''Replicas worth trying for the next read, starting from the next one in turn'''
+        now = monotonic()
+        start = next(self._next)
+        rotated = self.urls[start % len(self.urls):] + self.urls[:start % len(self.urls)]
+
+        return [url for url in rotated
+                if self._state[url]['down_until'] <= now and (self.due(url) or self._state[url]['lag'] <= self.max_lag)]
+
+    def due(self, url: str):
+        '''Whether a replica's lag needs measuring before it's read from'''
+        checked_at = self._state[url]['checked_at']
+        return checked_at is None or monotonic() - checked_at >= self.check_interval
+
+    def checked(self, url: str, lag: float):
+        '''Recording a lag measurement, returning whether the replica is fit for reads'''
+        self._state[url].update(lag=float(lag), checked_at=monotonic())
+        if lag > self.max_lag:
+            self.stats['lagging'] += 1
+            return False
+        return True
+
+    def failed(self, url: str):
+        self.stats['failures'] += 1
+        self._state[url]['down_until'] = monotonic() + self.retry_after
+
+    def pin(self, key):
+        '''Sending a key's reads to the primary for a while, after it wrote something'''
+        if key is None:
+            return
+
+        now = monotonic()
+        with self._lock:
+            if len(self._pinned) > 10000:
+                self._pinned = {k: until for k, until in self._pinned.items() if until > now}
+            self._pinned[key] = now + self.sticky_for
+
+    def pinned(self, key):
+        if key is None:
+            return False
+        until = self._pinned.get(key)
+        return until is not None and until > monotonic()
+
+    def metrics(self):
+        now = monotonic()
+        return {**self.stats,
+                'replicas': [{'lag': state['lag'], 'down': state['down_until'] > now} for state in self._state.values()]}
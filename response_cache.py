@@ -0,0 +1,130 @@
+from collections import OrderedDict
+from hashlib import blake2b
+from os import environ as env
+from time import monotonic
+from fastapi import Request, Response, status
+from leaderboard import leaderboard
+from utils import json_bytes
+
+
+class ResponseCache:
+    '''An in-process LRU cache of rendered JSON responses with strong ETags.
+
+        Entries carry tags (e.g. 'message:42', 'messages:public') that the write paths invalidate,
+        the cache is capped by the total size of the cached bodies, and `ttl` bounds how long
+        a write made by another process can go unnoticed.
+    '''
+
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024, ttl: float = 5):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._entries = OrderedDict()  # key -> (body, etag, tags, expires_at), least recently used first
+        self._tags = {}  # tag -> {key, ...}
+        self._bytes = 0
+        # bumped by every invalidation, so a response read from the DB before a write isn't cached after it
+        self.generation = 0
+        self.stats = {'hits': 0, 'misses': 0, 'not_modified': 0, 'evictions': 0}
+
+    def _forget(self, key):
+        body, _, tags, _ = self._entries.pop(key)
+        self._bytes -= len(body)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def get(self, key):
+        '''Getting (body, etag) of a fresh entry, or None'''
+        entry = self._entries.get(key)
+
+        if entry is None or entry[3] <= monotonic():
+            if entry is not None:
+                self._forget(key)
+            self.stats['misses'] += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.stats['hits'] += 1
+        return entry[0], entry[1]
+
+    def put(self, key, body: bytes, tags: list[str]):
+        '''Caching a rendered body and returning its ETag'''
+        etag = '"' + blake2b(body, digest_size=16).hexdigest() + '"'
+
+        if not self.max_bytes or len(body) > self.max_bytes:
+            return etag
+
+        if key in self._entries:
+            self._forget(key)
+
+        self._entries[key] = (body, etag, tuple(tags), monotonic() + self.ttl)
+        self._bytes += len(body)
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+
+        while self._bytes > self.max_bytes:
+            self._forget(next(iter(self._entries)))
+            self.stats['evictions'] += 1
+
+        return etag
+
+    def invalidate(self, *tags: str):
+        self.generation += 1
+        for tag in tags:
+            for key in list(self._tags.get(tag, ())):
+                self._forget(key)
+
+    @staticmethod
+    def _response(request: Request, body: bytes, etag: str):
+        headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match and (if_none_match.strip() == '*' or etag in (tag.strip() for tag in if_none_match.split(','))):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        return Response(content=body, media_type='application/json', headers=headers)
+
+    def respond(self, request: Request, key):
+        '''A response from the cache (a 304 if the client already has it), None on a miss'''
+        entry = self.get(key)
+        if entry is None:
+            return None
+
+        response = self._response(request, *entry)
+        if response.status_code == status.HTTP_304_NOT_MODIFIED:
+            self.stats['not_modified'] += 1
+        return response
+
+    def store(self, request: Request, key, content, tags: list[str], generation: int):
+        '''Rendering content to JSON, caching it unless something was invalidated since `generation`'''
+        body = json_bytes(content)
+
+        if generation == self.generation:
+            etag = self.put(key, body, tags)
+        else:
+            etag = '"' + blake2b(body, digest_size=16).hexdigest() + '"'
+
+        return self._response(request, body, etag)
+
+    def metrics(self):
+        return {**self.stats, 'entries': len(self._entries), 'bytes': self._bytes}
+
+
+response_cache = ResponseCache(max_bytes=int(env.get('RESPONSE_CACHE_BYTES', 16 * 1024 * 1024)),
+                               ttl=float(env.get('RESPONSE_CACHE_TTL', 5)))
+
+
+def invalidate_messages(user_id: int, message_id: int = None, public: bool = True):
+    '''Dropping what a write to a user's message could have changed: its own entry, the message lists it shows up in, the leaderboard'''
+    tags = [f'messages:user:{user_id}']
+    if public:
+        tags += ['messages:public', 'most_upvoted']
+    if message_id is not None:
+        tags.append(f'message:{message_id}')
+        if public:
+            # the in-memory board would otherwise keep showing it until its ttl runs out
+            leaderboard.discard(message_id)
+    response_cache.invalidate(*tags)
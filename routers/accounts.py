@@ -1,10 +1,13 @@
 from uuid import uuid4
 from fastapi import APIRouter, HTTPException, status, Query, Depends, Request
 from pydantic import BaseModel, EmailStr, SecretStr, ValidationError
-from psycopg2.errors import UniqueViolation
-from db import Database
-from dependencies import get_db
-from utils import get_psw_hash, prep_and_send
+from psycopg.errors import UniqueViolation
+from auth_cache import credential_cache
+from db_async import AsyncDatabase
+from dependencies import get_async_db, busy_error
+from hashing import hasher, HasherBusy
+from utils import activation_email
+import outbox
 
 router = APIRouter(tags=['Accounts'])
 
@@ -22,39 +25,35 @@ class User(BaseModel):
 #     return {'result': result}
 
 
+# what the activate_user() DB function's statuses mean for the API
+ACTIVATION_ERRORS = {
+    status.HTTP_404_NOT_FOUND: 'Invalid token!',
+    status.HTTP_409_CONFLICT: 'This user has been already activated!',
+    status.HTTP_410_GONE: 'This activation link has expired!',
+}
+
+
 @router.get('/activate')
-def activate(token: str, db: Database = Depends(get_db)):
-    # look for the token in the DB
-    # does the token belong to the user?
-    # if yes, and account is inactive, than activate it
-    token_db = db.get_one(table='tokens', columns=[
-        'token', 'user_id'], where={'token': token})
-
-    if token_db:
-        user_active = db.get_one(table='users', columns=['active'], where={
-            'id': token_db.get('user_id')})
-        if not user_active.get('active'):
-            # we could have passed 'now()' - a DB function, so we would stick to DB timestamps
-            # dt = datetime.now()
-            result = db.update('users', ['active', 'activated_at'], [
-                'true', 'now()'], where={'id': token_db.get('user_id')})
-            return {'Activated users': result}
-            # return {'message': 'Token is found!', 'result': token}
-        else:
-            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
-                                detail='This user has been already activated!')
-    else:
+async def activate(token: str, db: AsyncDatabase = Depends(get_async_db)):
+    # the token lookup (through its unique index), the expiry and activated checks, the activation
+    # and marking the token used are a single statement in the activate_user() DB function
+    result = (await db.call('activate_user', [token]))[0]
+
+    if result['status'] in ACTIVATION_ERRORS:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
-                            detail='Invalid token!')
+                            detail=ACTIVATION_ERRORS[result['status']])
+
+    credential_cache.invalidate(result['user_id'])
+    return {'Activated users': 1}
 
 
 @router.post('/register', status_code=status.HTTP_201_CREATED)
-def register(email: str, password: SecretStr = Query(default=None, min_length=8, max_length=16), db: Database = Depends(get_db), req: Request = None):
+async def register(email: str, password: SecretStr = Query(default=None, min_length=8, max_length=16), db: AsyncDatabase = Depends(get_async_db), req: Request = None):
     '''Registring a user for our guestbook (with storing email and psw in DB)'''
 
     try:
         user = User(email=email, password=password)
-        hashed_password = get_psw_hash(password.get_secret_value())
+        hashed_password = await hasher.hash(password.get_secret_value())
 
         # store hashed psw in DB
         # with db.conn:
@@ -63,16 +62,22 @@ def register(email: str, password: SecretStr = Query(default=None, min_length=8,
         #             user.email, hashed_password)
         #     )
 
-        user_id = db.write(table='users', columns=['email', 'password'], values=[
-            user.email, hashed_password])
-
         user_token = str(uuid4())
-        db.write(table='tokens', columns=['token', 'user_id'], values=[
-            user_token, user_id])
-
         activation_url = f"{req.base_url}activate?token={user_token}"
+        subject, body = activation_email(activation_url)
+
+        # the user, their token and the activation email are committed together (one commit), or not at all
+        async with db.transaction():
+            user_id = await db.write(table='users', columns=['email', 'password'], values=[
+                user.email, hashed_password])
+
+            await db.write(table='tokens', columns=['token', 'user_id'], values=[
+                user_token, user_id])
 
-        prep_and_send(user.email, activation_url)
+            # the email is only queued here, the outbox worker sends it in the background over a reusable SMTP session
+            await db.write(table='email_outbox', columns=['email_to', 'subject', 'body'], values=[
+                user.email, subject, body])
+        outbox.notify()
 
         return {'status': 'You have successfully registered! Please activate your account by clicking on the link sent to your email.'}
     except ValidationError:
@@ -83,3 +88,5 @@ def register(email: str, password: SecretStr = Query(default=None, min_length=8,
         raise HTTPException(status_code=status.HTTP_406_NOT_ACCEPTABLE,
                             detail='A user by this email is already registered!')
         # return {'error': 'A user by this email is already registered!'}
+    except HasherBusy:
+        raise busy_error()
@@ -1,92 +1,162 @@
-from fastapi import APIRouter, Form, Depends, HTTPException, status
-from db import Database
-from dependencies import get_db, validate_user
+from datetime import datetime
+from fastapi import APIRouter, Form, Body, Depends, HTTPException, status, Query, Path, Request, Response
+from fastapi.responses import StreamingResponse, ORJSONResponse
+from pydantic import conint
+from db_async import AsyncDatabase
+from dependencies import get_async_db, validate_user, busy_error
+from leaderboard import leaderboard
+from response_cache import response_cache, invalidate_messages
+from schemas import MessagesPage, FoundMessagesPage, TopMessage, NewMessage
+from utils import decode_cursor, next_cursor, ndjson_chunks, csv_chunks, as_dicts
+import write_behind
+from write_behind import BufferFull
 
 router = APIRouter(tags=['Messages'])
 
 
-@router.get('/messages/most_upvoted')
-def get_most_upvoted_messages(db: Database = Depends(get_db)):
-    messages = db.get('top_messages', ['id', 'message', 'n_upvotes'])
-    return messages
+@router.get('/messages/most_upvoted', response_model=list[TopMessage], response_class=ORJSONResponse)
+async def get_most_upvoted_messages(request: Request, db: AsyncDatabase = Depends(get_async_db)):
+    cached = response_cache.respond(request, ('most_upvoted',))
+    if cached:
+        return cached
 
+    # served from memory, top_messages (an index on guestbook.n_upvotes) is only read when the board is due a refresh
+    generation = response_cache.generation
+    messages = await leaderboard.get(db)
+    return response_cache.store(request, ('most_upvoted',), messages, tags=['most_upvoted'], generation=generation)
 
-@router.post('/messages/{message_id}/upvote')
-def upvote_a_message(message_id: int, db: Database = Depends(get_db), user_id: int = Depends(validate_user)):
-    # try to get the message
-    # if doesn't exist, raise HTTP exc
-    # if it does exists, but it's owned by this user, is a private one, or it was already upvoted, raise HTTP exc
-    # otherwise upvote the message
-    message_db = db.get_one(
-        'guestbook', ['id', 'user_id', 'private'], where={'id': message_id})
-
-    if not message_db:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail='A message by this ID was not found.')
 
-    if message_db.get('user_id') == user_id or message_db.get('private'):
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
-                            detail='You can not upvote your own or private messages!')
+# guestbook.id is an integer, the upvote functions take one: a bigger id would be sent as a bigint and fail the call
+MAX_ID = 2 ** 31 - 1
 
-    already_upvoted = db.get_one(
-        'upvotes', ['id'], where={'message_id': message_id, 'user_id': user_id})
+# the statuses upvote_message() returns, mapped to what the API answers with
+UPVOTE_ERRORS = {
+    status.HTTP_404_NOT_FOUND: (status.HTTP_404_NOT_FOUND, 'A message by this ID was not found.'),
+    status.HTTP_403_FORBIDDEN: (status.HTTP_403_FORBIDDEN, 'You can not upvote your own or private messages!'),
+    status.HTTP_409_CONFLICT: (status.HTTP_403_FORBIDDEN, 'You can not upvote the same message more than once!'),
+}
 
-    if already_upvoted:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
-                            detail='You can not upvote the same message more than once!')
 
-    upvoted_message = db.write(table='upvotes', columns=['user_id', 'message_id'], values=[
-        user_id, message_id])
+@router.post('/messages/{message_id}/upvote')
+async def upvote_a_message(response: Response, message_id: int = Path(..., le=MAX_ID),
+                           db: AsyncDatabase = Depends(get_async_db), user_id: int = Depends(validate_user)):
+    if write_behind.upvotes.running:
+        # written with others in a moment, upvote_message()'s checks are applied then and what they turn down is left out
+        try:
+            await write_behind.upvotes.add((user_id, message_id))
+        except BufferFull:
+            raise busy_error()
+
+        response.status_code = status.HTTP_202_ACCEPTED
+        return {'Result': 'An upvote was accepted, thank you!', 'message_id': message_id}
+
+    # the existence, ownership, privacy and duplicate checks are all done by the upvote_message() DB function
+    # in the same statement as the insert (with a unique index on upvotes backing it), so it's one round trip and race-free;
+    # the upvotes_count trigger bumps guestbook.n_upvotes in the same transaction;
+    # an upvote is cheap to lose in a DB crash, so its commit doesn't wait for the WAL flush
+    async with db.transaction(synchronous_commit=False):
+        result = (await db.call('upvote_message', [user_id, message_id]))[0]['upvote_message']
+
+    if result in UPVOTE_ERRORS:
+        status_code, detail = UPVOTE_ERRORS[result]
+        raise HTTPException(status_code=status_code, detail=detail)
+
+    leaderboard.upvoted(message_id)
+    response_cache.invalidate('most_upvoted')
 
     return {'Result': 'A message was successfully upvoted, thank you!', 'message_id': message_id}
 
 
+@router.post('/messages/upvotes')
+async def upvote_many_messages(message_ids: list[conint(le=MAX_ID)] = Body(..., embed=True, min_items=1, max_items=100),
+                               db: AsyncDatabase = Depends(get_async_db), user_id: int = Depends(validate_user)):
+    '''Upvoting a batch of messages in one request and one transaction, with a result per message'''
+    async with db.transaction(synchronous_commit=False):
+        results = await db.call('upvote_messages', [user_id, message_ids])
+
+    for result in results:
+        if result['status'] == status.HTTP_201_CREATED:
+            leaderboard.upvoted(result['message_id'])
+    response_cache.invalidate('most_upvoted')
+
+    return {'Results': [{'message_id': result['message_id'], 'upvoted': result['status'] == status.HTTP_201_CREATED,
+                         'detail': UPVOTE_ERRORS[result['status']][1] if result['status'] in UPVOTE_ERRORS else None}
+                        for result in results]}
+
+
 @router.post('/messages')
-def write_a_message_on_the_guestbook(message: str = Form(...), private: bool = Form(False),
-                                     db: Database = Depends(get_db), user_id: int = Depends(validate_user)):
-    message_id = db.write(table='guestbook', columns=['message', 'user_id', 'private'], values=[
+async def write_a_message_on_the_guestbook(response: Response, message: str = Form(...), private: bool = Form(False),
+                                           db: AsyncDatabase = Depends(get_async_db), user_id: int = Depends(validate_user)):
+    if write_behind.messages.running:
+        # written with others in a moment, so there's no id to give back yet
+        try:
+            await write_behind.messages.add((message, user_id, private))
+        except BufferFull:
+            raise busy_error()
+
+        response.status_code = status.HTTP_202_ACCEPTED
+        return {'Result': 'A message was accepted and will be stored shortly', 'message': message}
+
+    message_id = await db.write(table='guestbook', columns=['message', 'user_id', 'private'], values=[
         message, user_id, private])
+    invalidate_messages(user_id, public=not private)
 
     return {'Result': 'A message record inserted into DB', 'message_id': message_id, 'message': message}
 
 
+@router.post('/messages/batch')
+async def write_many_messages(messages: list[NewMessage] = Body(..., embed=True, min_items=1, max_items=100),
+                              db: AsyncDatabase = Depends(get_async_db), user_id: int = Depends(validate_user)):
+    '''Writing a batch of messages in one request, with multi-row inserts and a single commit'''
+    message_ids = await db.write_many(table='guestbook', columns=['message', 'user_id', 'private'],
+                                      rows=[(m.message, user_id, m.private) for m in messages])
+    invalidate_messages(user_id, public=not all(m.private for m in messages))
+
+    return {'Result': f'{len(message_ids)} message records inserted into DB', 'message_ids': message_ids}
+
+
 @router.patch('/messages/{message_id}')
-def update_a_specific_message(message_id: int, message: str = Form(...), private: bool = Form(False),
-                              db: Database = Depends(get_db),
-                              user_id: str = Depends(validate_user)):
+async def update_a_specific_message(message_id: int, message: str = Form(...), private: bool = Form(False),
+                                    db: AsyncDatabase = Depends(get_async_db),
+                                    user_id: str = Depends(validate_user)):
     # try to get the message
     # if it doesn't exist, raise HTTP Exc
     # if it does exists, but user_id doesn't own it, raise HTTP Exc
     # otherwise update the message
 
-    message_db = db.get_one(
-        'guestbook', ['id', 'user_id'], where={'id': message_id})
+    message_db = await db.get_one(
+        'guestbook', ['id', 'user_id', 'private'], where={'id': message_id})
 
     if not message_db:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail='Message was not found.')
 
     if message_db.get('user_id') == user_id:
-        result = db.update('guestbook', ['message', 'private'], [
-                           message, private], where={'id': message_id})
+        result = await db.update('guestbook', ['message', 'private'], [
+                                 message, private], where={'id': message_id})
+        # public listings change if the message was or now is public
+        invalidate_messages(user_id, message_id, public=not (private and message_db.get('private')))
         return {'Updated messages': result}
 
     raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                         detail='You are not allowed to update this message!')
 
 
-@router.get('/messages/search')
-def search_for_messages_by_keyword(search_pattern: str, num: int = 10, db: Database = Depends(get_db), user_id: int = Depends(validate_user)):
+@router.get('/messages/search', response_model=FoundMessagesPage, response_class=ORJSONResponse)
+async def search_for_messages_by_keyword(search_pattern: str, num: int = Query(default=10, ge=1, le=100), cursor: str = None,
+                                         db: AsyncDatabase = Depends(get_async_db), user_id: int = Depends(validate_user)):
 
-    # This doesn't work as expected, as we get additional messages due to only one AND with a LIKE search pattern.
-    # We could have refactored db.get so AND clause with search_pattern is present for both where and or_where.
-    # One more option - re-write SQL query to re-order query containers, so first we have WHERE LIKE search pattern, then AND (where or_where conditions).
-    # Alternatively, we could have created a DB function or view and just invoke it.
-    found_messages = db.get(table='guestbook', columns=['id', 'message', 'created_at'],
-                            limit=num, where={'private': False},
-                            or_where={'private': True, 'user_id': user_id}, contains={'message': search_pattern})
-
-    return found_messages
+    # db.get with contains= got us additional messages due to only one AND with a LIKE search pattern (and a seq scan of the guestbook),
+    # so now we use a full-text search over the indexed message_tsv column, where the match applies to both where and or_where
+    # pages follow the relevance order, so the cursor holds the (rank, id) of the last message
+    # rows come as (id, message, created_at, rank) tuples and are rendered by orjson, no per-row dict cursor or jsonable_encoder pass
+    found_messages = await db.search(table='guestbook', columns=['id', 'message', 'created_at'],
+                                     search=search_pattern, vector='message_tsv',
+                                     limit=num, where={'private': False},
+                                     or_where={'private': True, 'user_id': user_id},
+                                     after=decode_cursor(cursor, 'search', (float, int)) if cursor else None, as_tuples=True)
+    return ORJSONResponse({'messages': as_dicts(found_messages, ['id', 'message', 'created_at', 'rank']),
+                           'next_cursor': next_cursor(found_messages, num, [3, 0], 'search')})
 
     # public_messages = db.get(table='guestbook', columns=['id', 'message', 'private', 'created_at'],
     #                          where={'private': False}, contains={'message': search_pattern})
@@ -99,12 +169,40 @@ def search_for_messages_by_keyword(search_pattern: str, num: int = 10, db: Datab
     # return found_messages[:num]
 
 
-@router.get('/messages/{message_id}')
-def view_a_specific_message(message_id: int,
-                            db: Database = Depends(get_db),
-                            user_id: str = Depends(validate_user)):
+EXPORT_COLUMNS = ['id', 'message', 'created_at', 'private']
+
+
+@router.get('/messages/export')
+async def export_messages(format: str = Query(default='ndjson', regex='^(ndjson|csv)$'),
+                          fetch_size: int = Query(default=None, ge=1, le=10000),
+                          db: AsyncDatabase = Depends(get_async_db), user_id: int = Depends(validate_user)):
+
+    # every message the caller can see, oldest first, read through a server-side cursor and sent batch by batch,
+    # so the first rows go out right away and memory use doesn't depend on how many there are
+    batches = db.stream(table='guestbook', columns=EXPORT_COLUMNS,
+                        where={'private': False}, or_where={'private': True, 'user_id': user_id},
+                        order_by=['created_at', 'id'], fetch_size=fetch_size)
 
-    message_db = db.get_one(
+    if format == 'csv':
+        return StreamingResponse(csv_chunks(batches, EXPORT_COLUMNS), media_type='text/csv',
+                                 headers={'Content-Disposition': 'attachment; filename="messages.csv"'})
+
+    return StreamingResponse(ndjson_chunks(batches), media_type='application/x-ndjson')
+
+
+@router.get('/messages/{message_id}')
+async def view_a_specific_message(message_id: int, request: Request,
+                                  db: AsyncDatabase = Depends(get_async_db),
+                                  user_id: str = Depends(validate_user)):
+
+    # a public message is cached once for everyone, a private one only for its owner
+    cached = response_cache.respond(request, ('message', message_id)) or \
+        response_cache.respond(request, ('message', message_id, user_id))
+    if cached:
+        return cached
+
+    generation = response_cache.generation
+    message_db = await db.get_one(
         'guestbook', ['id', 'user_id', 'message', 'created_at', 'private'], where={'id': message_id})
 
     if not message_db:
@@ -115,11 +213,21 @@ def view_a_specific_message(message_id: int,
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                             detail='You are not allowed to view this message!')
 
-    return {'id': message_db.get('id'), 'message': message_db.get('message'), 'created_at': message_db.get('created_at')}
+    key = ('message', message_id, user_id) if message_db.get('private') else ('message', message_id)
+    return response_cache.store(request, key, {'id': message_db.get('id'), 'message': message_db.get('message'), 'created_at': message_db.get('created_at')},
+                                tags=[f'message:{message_id}'], generation=generation)
 
 
-@router.get('/messages')
-def get_all_messages(num: int = 3, db: Database = Depends(get_db), user_id: int = Depends(validate_user)):
+@router.get('/messages', response_model=MessagesPage, response_class=ORJSONResponse)
+async def get_all_messages(request: Request, num: int = Query(default=3, ge=1, le=100), cursor: str = None,
+                           db: AsyncDatabase = Depends(get_async_db), user_id: int = Depends(validate_user)):
+
+    # the page is cached per user, since it holds the caller's private messages along with the public ones
+    key = ('messages', user_id, num, cursor)
+    cached = response_cache.respond(request, key)
+    if cached:
+        return cached
+    generation = response_cache.generation
 
     # messages_all = db.get(table='guestbook', columns=[
     #                       'id', 'user_id', 'message', 'created_at', 'private'])
@@ -145,21 +253,27 @@ def get_all_messages(num: int = 3, db: Database = Depends(get_db), user_id: int
 
     # return total_messages[:num]
 
-    # Using refactored .get method with an additional or_where conditions
-    total_messages = db.get(table='guestbook', columns=['id', 'message', 'created_at'],
-                            limit=num, where={'private': False},
-                            or_where={'private': True, 'user_id': user_id})
-
-    return total_messages
+    # Using refactored .get method with an additional or_where conditions,
+    # newest first and paged by (created_at, id) keyset, so deep pages cost the same as the first one
+    total_messages = await db.get(table='guestbook', columns=['id', 'message', 'created_at'],
+                                  limit=num, where={'private': False},
+                                  or_where={'private': True, 'user_id': user_id},
+                                  order_by=['created_at', 'id'], desc=True,
+                                  after=decode_cursor(cursor, 'messages', (datetime, int)) if cursor else None, as_tuples=True)
+    return response_cache.store(request, key, {'messages': as_dicts(total_messages, ['id', 'message', 'created_at']),
+                                               'next_cursor': next_cursor(total_messages, num, [2, 0], 'messages')},
+                                tags=['messages:public', f'messages:user:{user_id}'], generation=generation)
 
 
 @router.delete('/messages/{message_id}')
-def delete_a_specific_message(message_id: int, db: Database = Depends(get_db), user_id: int = Depends(validate_user)):
+async def delete_a_specific_message(message_id: int, db: AsyncDatabase = Depends(get_async_db), user_id: int = Depends(validate_user)):
 
-    result = db.delete('guestbook', {'id': message_id, 'user_id': user_id})
+    result = await db.delete('guestbook', {'id': message_id, 'user_id': user_id})
 
     if not result:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail='Message was not found or you do not have permission to delete it.')
 
+    invalidate_messages(user_id, message_id)
+
     return {'Deleted messages': result}
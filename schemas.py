@@ -0,0 +1,35 @@
+from datetime import datetime
+from pydantic import BaseModel
+
+
+# response models of the message routes: they document the responses, which are rendered straight from DB rows
+class Message(BaseModel):
+    id: int
+    message: str
+    created_at: datetime
+
+
+class MessagesPage(BaseModel):
+    messages: list[Message]
+    next_cursor: str = None
+
+
+class FoundMessage(Message):
+    rank: float
+
+
+class FoundMessagesPage(BaseModel):
+    messages: list[FoundMessage]
+    next_cursor: str = None
+
+
+class TopMessage(BaseModel):
+    id: int
+    message: str
+    n_upvotes: int
+
+
+# request models
+class NewMessage(BaseModel):
+    message: str
+    private: bool = False
@@ -0,0 +1,148 @@
+from argparse import ArgumentParser
+from os import environ as env, cpu_count, fork, getpid, getppid, kill, waitpid, WIFEXITED, WEXITSTATUS, WIFSIGNALED, WTERMSIG, _exit
+import signal
+import socket
+from time import monotonic, sleep
+import logging
+import uvicorn
+
+log = logging.getLogger('guestbook.serve')
+
+
+def listen(host: str, port: int, backlog: int):
+    '''The listening socket, bound once in the master and accepted from by every worker'''
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class WorkerServer(uvicorn.Server):
+    '''A uvicorn server that shuts down if its master is gone (killed without getting to stop its workers)'''
+
+    def __init__(self, config, master: int):
+        super().__init__(config)
+        self.master = master
+
+    async def on_tick(self, counter: int):
+        if counter % 10 == 0 and getppid() != self.master:
+            self.should_exit = True
+        return await super().on_tick(counter)
+
+
+def run_worker(app, sock, args, master: int):
+    '''Serving in a forked worker: the DB pool, hashing processes and so on are only created here, in the startup event'''
+    # the master's handlers are for the master, uvicorn installs its own
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    config = uvicorn.Config(app, backlog=args.backlog, access_log=args.access_log, proxy_headers=args.proxy_headers,
+                            forwarded_allow_ips=args.forwarded_allow_ips, timeout_keep_alive=args.timeout_keep_alive,
+                            log_level=args.log_level, log_config=None)  # logging as configured by the master
+    WorkerServer(config, master).run(sockets=[sock])
+
+
+class Master:
+    '''Forking the workers off the preloaded app and keeping them running until told to stop'''
+
+    def __init__(self, app, sock, args):
+        self.app = app
+        self.sock = sock
+        self.args = args
+
+        self.workers = {}  # pid -> started at
+        self.stopping = False
+
+    def spawn(self):
+        master = getpid()
+        pid = fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(self.app, self.sock, self.args, master)
+            except BaseException:
+                log.exception('Worker %d failed', getpid())
+                code = 1
+            finally:
+                _exit(code)
+
+        self.workers[pid] = monotonic()
+        log.info('Started worker %d', pid)
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        for pid in self.workers:
+            try:
+                kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for _ in range(self.args.workers):
+            self.spawn()
+
+        while self.workers:
+            try:
+                pid, status = waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+
+            started = self.workers.pop(pid, None)
+            if started is None:
+                continue
+
+            if WIFSIGNALED(status):
+                log.warning('Worker %d was killed by signal %d', pid, WTERMSIG(status))
+            elif WIFEXITED(status) and WEXITSTATUS(status):
+                log.warning('Worker %d exited with status %d', pid, WEXITSTATUS(status))
+
+            if not self.stopping:
+                # a worker dying right after it started (e.g. a bad setting) would otherwise be respawned in a tight loop
+                if monotonic() - started < 1:
+                    sleep(1)
+                self.spawn()
+
+
+def main():
+    parser = ArgumentParser(prog='python serve.py', description='Serve the API from preforked worker processes')
+    parser.add_argument('--host', default=env.get('HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(env.get('PORT', 8000)))
+    parser.add_argument('--workers', type=int, default=int(env.get('WEB_CONCURRENCY', 0)) or cpu_count() or 1,
+                        help='worker processes (WEB_CONCURRENCY), one per core by default')
+    parser.add_argument('--backlog', type=int, default=2048)
+    parser.add_argument('--timeout-keep-alive', type=int, default=5)
+    parser.add_argument('--access-log', action='store_true')
+    parser.add_argument('--proxy-headers', action='store_true', help='trust X-Forwarded-* from --forwarded-allow-ips')
+    parser.add_argument('--forwarded-allow-ips', default='127.0.0.1')
+    parser.add_argument('--log-level', default='info')
+    parser.add_argument('--env-file', default='.env', help='loaded before the app is imported, if it exists')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(process)d %(name)s %(levelname)s %(message)s')
+
+    from dotenv import load_dotenv
+    load_dotenv(args.env_file)
+
+    # the workers' bcrypt process pools share the cores between them rather than each taking all of them
+    env.setdefault('HASHER_WORKERS', str(max((cpu_count() or 1) // args.workers, 1)))
+
+    # preloading: importing the app and building its routes and OpenAPI schema once, shared copy-on-write by the workers;
+    # nothing here may open a connection or start a thread, those belong to each worker's startup
+    started = monotonic()
+    from main import app
+    app.openapi()
+    log.info('Loaded the app in %.0f ms, forking %d workers', (monotonic() - started) * 1000, args.workers)
+
+    sock = listen(args.host, args.port, args.backlog)
+    Master(app, sock, args).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,31 +1,118 @@
-from passlib.context import CryptContext
-from os import environ as env
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
 from fastapi import HTTPException, status
-import smtplib
+import csv
+import io
+import json
+from math import isfinite
+from struct import pack, unpack
+import orjson
 
-pwd_context = CryptContext(schemes=['bcrypt'])
+_pwd_context = None
+
+
+def pwd_context():
+    '''The bcrypt context, built on first use: only the hashing worker processes need it, not every importer'''
+    global _pwd_context
+
+    if _pwd_context is None:
+        from passlib.context import CryptContext
+        _pwd_context = CryptContext(schemes=['bcrypt'])
+    return _pwd_context
 
 
 def get_psw_hash(password):
-    return pwd_context.hash(password)
+    return pwd_context().hash(password)
 
 
 def verify_psw(plain_psw, hashed_psw):
-    return pwd_context.verify(plain_psw, hashed_psw)
+    return pwd_context().verify(plain_psw, hashed_psw)
+
+
+def activation_email(activation_url):
+    '''The subject and body of an account activation email'''
+    return 'GuestBookAPI Account Activation', f"Please activate your account by going to this link: {activation_url}"
+
 
+def encode_cursor(values: list, kind: str):
+    '''Packing the sort key values of the last row of a page into an opaque, url-safe cursor,
+        tagged with the kind of listing (e.g. the endpoint) it pages through
+    '''
+    payload = json.dumps({'kind': kind, 'after': values}, separators=(',', ':'),
+                         default=lambda v: {'dt': v.isoformat()} if isinstance(v, datetime) else str(v))
+    return urlsafe_b64encode(payload.encode('utf8')).decode('ascii')
 
-def prep_and_send(email_to, activation_url):
+
+def _real(value):
+    '''Whether a number casts to real (float4): finite, and neither too big for it nor too small to be told from 0'''
     try:
+        packed = unpack('f', pack('f', float(value)))[0]
+    except OverflowError:
+        return False
+    return isfinite(packed) and (packed != 0 or value == 0)
+
+
+def _cursor_value(value, type_: type):
+    # bool is an int in Python, but never a sort key; an int is fine where a float is expected;
+    # float sort keys are ranks, compared as real in the keyset predicate
+    if isinstance(value, bool):
+        return False
+    if type_ is float:
+        return isinstance(value, (int, float)) and _real(value)
+    return isinstance(value, type_)
 
-        my_email = env.get("UKRNET_ADDR")
-        email_message = f"From: {my_email}\nSubject:GuestBookAPI Account Activation\n\nPlease activate your account by going to this link: {activation_url}".encode(
-            "utf8")
 
-        with smtplib.SMTP_SSL("smtp.ukr.net", port=465) as connection:
-            connection.login(my_email, env.get("UKRNET_APP_PWD"))
-            connection.sendmail(from_addr=my_email,
-                                to_addrs=email_to, msg=email_message)
+def decode_cursor(cursor: str, kind: str, types: tuple):
+    '''Unpacking a cursor made by encode_cursor for the same kind of listing, with a value of each of `types`'''
+    try:
+        payload = json.loads(urlsafe_b64decode(cursor.encode('ascii')),
+                             object_hook=lambda d: datetime.fromisoformat(d['dt']) if set(d) == {'dt'} else d)
+    except Exception:
+        payload = None
+
+    after = payload.get('after') if isinstance(payload, dict) and payload.get('kind') == kind else None
 
-    except Exception as e:
+    if not isinstance(after, list) or len(after) != len(types) \
+            or not all(_cursor_value(value, type_) for value, type_ in zip(after, types)):
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Unable to send email. Your activation URL is {activation_url}")
+            status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid cursor!')
+
+    return after
+
+
+def next_cursor(rows: list, num: int, keys: list, kind: str):
+    '''A cursor for the page after `rows`, or None if this page wasn't full (so it's the last one);
+        keys are column names for dict rows, positions for tuple rows
+    '''
+    if rows and len(rows) == num:
+        return encode_cursor([rows[-1][k] for k in keys], kind)
+
+
+def json_bytes(content):
+    '''Rendering content as compact JSON bytes with orjson, which handles datetimes itself (no jsonable_encoder pass)'''
+    return orjson.dumps(content, default=str, option=orjson.OPT_NON_STR_KEYS)
+
+
+def as_dicts(rows: list, keys: list[str]):
+    '''Tuple rows (see Database.get's as_tuples) as the dicts they serialize to'''
+    return [dict(zip(keys, row)) for row in rows]
+
+
+async def ndjson_chunks(batches):
+    '''Rendering (async) batches of rows as newline delimited JSON, one chunk per batch'''
+    async for batch in batches:
+        yield b''.join(orjson.dumps(row, default=str, option=orjson.OPT_APPEND_NEWLINE) for row in batch)
+
+
+async def csv_chunks(batches, columns: list[str]):
+    '''Rendering (async) batches of rows as CSV with a header line, one chunk per batch'''
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction='ignore')
+    writer.writeheader()
+    yield buffer.getvalue()
+
+    async for batch in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(batch)
+        yield buffer.getvalue()
@@ -0,0 +1,91 @@
+from threading import Thread, Event
+from time import monotonic
+import logging
+from db import Database
+
+
+class PeriodicWorker(Thread):
+    '''A background thread doing a round of work with a DB connection of its own every `interval` seconds.
+
+        A round that fails is logged and the next one goes ahead as planned; notify() starts the next one right away.
+    '''
+
+    def __init__(self, name: str, interval: float, log: logging.Logger):
+        super().__init__(name=name, daemon=True)
+        self.interval = interval
+        self.log = log
+
+        self._wakeup = Event()
+        self._stopping = Event()
+        self._started_at = None
+
+    def work(self, db: Database):
+        '''One round of work'''
+        raise NotImplementedError
+
+    def finish(self):
+        '''Cleaning up after the last round'''
+
+    def notify(self):
+        '''Letting the worker know there is something new to do, rather than waiting for the next round'''
+        self._wakeup.set()
+
+    def stop(self, timeout: float = None):
+        self._stopping.set()
+        self._wakeup.set()
+        self.join(timeout)
+
+    def run(self):
+        self._started_at = monotonic()
+
+        while not self._stopping.is_set():
+            db = Database()
+            try:
+                db.open()
+                self.work(db)
+            except Exception:
+                self.log.exception('%s failed', self.name)
+            finally:
+                db.close()
+
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+        self.finish()
+
+
+class WorkerSlot:
+    '''The one worker of a kind a process runs, created with `create` when started (e.g. by the app's startup)'''
+
+    def __init__(self, create):
+        self.create = create
+        self.worker = None
+
+    def start(self):
+        if self.worker is None:
+            self.worker = self.create()
+            self.worker.start()
+
+    def stop(self, timeout: float = 10):
+        if self.worker is not None:
+            self.worker.stop(timeout=timeout)
+            self.worker = None
+
+    def notify(self):
+        if self.worker is not None:
+            self.worker.notify()
+
+    def metrics(self):
+        return self.worker.metrics() if self.worker is not None else None
+
+
+def run_standalone(create):
+    '''Running a worker as a process of its own until interrupted'''
+    logging.basicConfig(level='INFO', format='%(asctime)s %(process)d %(name)s %(levelname)s %(message)s')
+
+    worker = create()
+    worker.start()
+    try:
+        worker.join()
+    except KeyboardInterrupt:
+        worker.stop()
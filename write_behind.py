@@ -0,0 +1,210 @@
+from asyncio import Queue, QueueEmpty, QueueFull, create_task, sleep, wait_for, TimeoutError as AsyncTimeoutError
+from os import environ as env
+from time import monotonic
+import logging
+from psycopg import DataError, IntegrityError
+from db_async import AsyncDatabase
+from leaderboard import leaderboard
+from response_cache import response_cache, invalidate_messages
+
+log = logging.getLogger('guestbook.write_behind')
+
+# put into a buffer's queue by stop(), behind the writes still to be flushed
+_STOP = object()
+
+
+class BufferFull(Exception):
+    '''Raised when a write found no room in a write-behind buffer within its timeout'''
+
+
+class WriteBehindBuffer:
+    '''A bounded in-process buffer of accepted writes, flushed to the DB in batches by a background task.
+
+        A batch is flushed once `batch_size` writes are waiting or `flush_interval` seconds after its first write,
+        whichever comes first. A full buffer makes writers wait up to `put_timeout` seconds before BufferFull is raised.
+        A batch the DB rejects is retried row by row, so one bad row doesn't lose the others; a batch that fails
+        for other reasons (e.g. the DB being unreachable) is retried up to `max_attempts` times, then dropped.
+        Writes still buffered when the process stops are flushed by stop(), those buffered when it crashes are lost.
+    '''
+
+    def __init__(self, name: str, flush, max_size: int = 10000, batch_size: int = 500, flush_interval: float = 0.05,
+                 put_timeout: float = 1, max_attempts: int = 5, backoff: float = 0.5):
+        self.name = name
+        self.flush = flush  # a coroutine function writing a batch (a list of rows) with an AsyncDatabase
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+
+        self._queue = None
+        self._task = None
+        self._stopping = False
+        self.stats = {'accepted': 0, 'rejected': 0, 'written': 0, 'dropped': 0, 'batches': 0, 'retries': 0,
+                      'flush_time_total': 0.0, 'flush_time_max': 0.0}
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    async def add(self, row):
+        '''Buffering a write, waiting for room if the buffer is full'''
+        if self._task is None or self._stopping:
+            self.stats['rejected'] += 1
+            raise BufferFull(f'The {self.name} write-behind buffer is not taking writes')
+
+        try:
+            self._queue.put_nowait(row)
+        except QueueFull:
+            try:
+                await wait_for(self._queue.put(row), self.put_timeout)
+            except AsyncTimeoutError:
+                self.stats['rejected'] += 1
+                raise BufferFull(f'The {self.name} write-behind buffer is full')
+
+        self.stats['accepted'] += 1
+
+    def start(self):
+        '''Starting the flushing task on the running event loop'''
+        if self._task is None:
+            self._queue = Queue(self.max_size)
+            self._stopping = False
+            self._task = create_task(self._run(), name=f'write-behind-{self.name}')
+
+    async def stop(self):
+        '''Turning new writes away and flushing whatever is buffered'''
+        if self._task is None:
+            return
+
+        self._stopping = True
+        # after the writes already buffered, so the task flushes them before it sees it
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+
+        # writers that were waiting for room got it while the task was flushing
+        while not self._queue.empty():
+            await self._write(self._take(self.batch_size))
+
+    def _take(self, limit: int):
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self._queue.get_nowait())
+            except QueueEmpty:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            deadline = monotonic() + self.flush_interval
+
+            while len(batch) < self.batch_size and _STOP not in batch:
+                batch += self._take(self.batch_size - len(batch))
+                left = deadline - monotonic()
+                if len(batch) >= self.batch_size or _STOP in batch or left <= 0:
+                    break
+                try:
+                    batch.append(await wait_for(self._queue.get(), left))
+                except AsyncTimeoutError:
+                    break
+
+            if _STOP in batch:
+                batch.remove(_STOP)
+                if batch:
+                    await self._write(batch)
+                return
+
+            await self._write(batch)
+
+    async def _flush_once(self, batch: list):
+        db = AsyncDatabase()
+        try:
+            await db.open()
+            await self.flush(db, batch)
+        finally:
+            await db.close()
+
+    async def _write(self, batch: list):
+        started = monotonic()
+
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                await self._flush_once(batch)
+            except (DataError, IntegrityError) as e:
+                if len(batch) == 1:
+                    log.warning('Dropping a buffered %s write the DB rejected: %r', self.name, e)
+                    self.stats['dropped'] += 1
+                    return
+                # a row of the batch was turned down, writing them one by one keeps the others
+                for row in batch:
+                    await self._write([row])
+                return
+            except Exception as e:
+                log.warning('Flushing %d buffered %s writes failed (attempt %d): %r', len(batch), self.name, attempt, e)
+                self.stats['retries'] += 1
+                await sleep(self.backoff * 2 ** (attempt - 1))
+                continue
+
+            took = monotonic() - started
+            self.stats['batches'] += 1
+            self.stats['written'] += len(batch)
+            self.stats['flush_time_total'] += took
+            self.stats['flush_time_max'] = max(self.stats['flush_time_max'], took)
+            return
+
+        log.error('Dropping %d buffered %s writes after %d attempts', len(batch), self.name, self.max_attempts)
+        self.stats['dropped'] += len(batch)
+
+    def metrics(self):
+        return {**self.stats, 'pending': self._queue.qsize() if self._queue is not None else 0,
+                'flush_time_avg': self.stats['flush_time_total'] / (self.stats['batches'] or 1)}
+
+
+async def flush_messages(db: AsyncDatabase, rows: list):
+    '''Writing buffered (message, user_id, private) rows with one multi-row insert per page'''
+    await db.write_many('guestbook', ['message', 'user_id', 'private'], rows)
+
+    public = {user_id for _, user_id, private in rows if not private}
+    for user_id in {user_id for _, user_id, _ in rows}:
+        invalidate_messages(user_id, public=user_id in public)
+
+
+async def flush_upvotes(db: AsyncDatabase, rows: list):
+    '''Applying buffered (user_id, message_id) upvotes with one upvote_pairs() call, with upvote_message()'s checks;
+        the ones it turns down (no such message, own or private message, already upvoted) are just left out
+    '''
+    async with db.transaction(synchronous_commit=False):
+        results = await db.call('upvote_pairs', [[user_id for user_id, _ in rows], [message_id for _, message_id in rows]])
+
+    for result in results:
+        if result['status'] == 201:
+            leaderboard.upvoted(result['message_id'])
+    response_cache.invalidate('most_upvoted')
+
+
+def create_buffer(name: str, flush):
+    return WriteBehindBuffer(name, flush, max_size=int(env.get('WRITE_BEHIND_MAX_SIZE', 10000)),
+                             batch_size=int(env.get('WRITE_BEHIND_BATCH_SIZE', 500)),
+                             flush_interval=float(env.get('WRITE_BEHIND_FLUSH_MS', 50)) / 1000,
+                             put_timeout=float(env.get('WRITE_BEHIND_PUT_TIMEOUT', 1)))
+
+
+messages = create_buffer('messages', flush_messages)
+upvotes = create_buffer('upvotes', flush_upvotes)
+
+
+def start():
+    messages.start()
+    upvotes.start()
+
+
+async def stop():
+    await messages.stop()
+    await upvotes.stop()
+
+
+def metrics():
+    return {'messages': messages.metrics(), 'upvotes': upvotes.metrics()} if messages.running else None